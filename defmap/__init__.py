@@ -29,7 +29,11 @@ import pwem
 from pyworkflow import Config
 import pyworkflow.utils as pwutils
 from defmap.constants import *
+from defmap.cache import DefmapCache
+from defmap.environment import getEnvironment, getCpuEnviron
 import os
+import subprocess
+import tempfile
 
 
 _references = ['Matsumoto2021']
@@ -56,10 +60,22 @@ class Plugin(pwem.Plugin):
         return environ
 
     
-    # @classmethod
-    # def _defineVariables(cls):
-    #     Create a variable in scipion.config of the external repository
-    #     cls._defineEmVar(DEFMAP_DIC['home'], DEFAULT_ENV_NAME)
+    @classmethod
+    def _defineVariables(cls):
+        # Socket and idle timeout of the warm inference worker
+        cls._defineVar(DEFMAP_WORKER_SOCKET,
+                       os.path.join(tempfile.gettempdir(), "defmap-worker-%d.sock" % os.getuid()))
+        cls._defineVar(DEFMAP_WORKER_TIMEOUT, DEFAULT_WORKER_TIMEOUT)
+        # Cache of datasets and predictions, disabled if no folder is given
+        cls._defineVar(DEFMAP_CACHE_DIR, '')
+        cls._defineVar(DEFMAP_CACHE_SIZE, DEFAULT_CACHE_SIZE)
+        # Interpreter and variables of the conda environment, resolved once
+        cls._defineVar(DEFMAP_ENV_CACHE,
+                       os.path.join(tempfile.gettempdir(), "defmap-env-%d.json" % os.getuid()))
+        # Folder with the archives for the offline install, not used if empty
+        cls._defineVar(DEFMAP_PACKED_DIR, '')
+        # Install the ONNX packages with the environment, for the ONNX Runtime inference
+        cls._defineVar(DEFMAP_INSTALL_ONNX, 'True')
 
     @classmethod
     def getDependencies(cls):
@@ -67,21 +83,152 @@ class Plugin(pwem.Plugin):
         activation command was not found. """
         condaActivationCmd = cls.getCondaActivationCmd()
         neededProgs = []
-        if not condaActivationCmd:
+        if not condaActivationCmd and not cls.getPackedArchives(DEFAULT_VERSION):
             neededProgs.append('conda')
 
         return neededProgs
     
     @classmethod
     def getEnvActivationCommand(cls, packageDictionary=None, condaHook=True):
+        packedActivation = os.path.join(cls.getScriptLocation("packed-env"), 'bin', 'activate')
+        if os.path.exists(packedActivation):
+            return '. "%s"' % packedActivation
         return '{}conda activate {}'.format(cls.getCondaActivationCmd(), DEFAULT_ENV_NAME)
 
 
+    @classmethod
+    def getDefmapEnviron(cls):
+        """ Python of the DefMap environment and the variables to run it, as
+        after "conda activate". They are resolved the first time and kept in
+        DEFMAP_ENV_CACHE until the environment changes. """
+        return getEnvironment(cls.getVar(DEFMAP_ENV_CACHE), cls.getEnvActivationCommand(), cls.getEnviron())
+
+    @classmethod
+    def runDefmap(cls, protocol, script, args, cwd=None, cpuThreads=0, cpuList=''):
+        """ Run a python script in the DefMap environment without activating it.
+        With cpuThreads, TensorFlow runs on the CPU with that many threads,
+        pinned to the cores of cpuList if given. """
+        python, environ = cls.getDefmapEnviron()
+        program, args = python, '"%s" %s' % (script, args)
+        if cpuThreads:
+            environ.update(getCpuEnviron(cpuThreads))
+        if cpuList:
+            program, args = 'taskset', '-c %s "%s" %s' % (cpuList, python, args)
+        protocol.runJob(program, args, env=environ, cwd=cwd)
+
+    @classmethod
+    def hasOnnxPackages(cls):
+        """ Whether the DefMap environment has the ONNX packages, without importing them. """
+        python, environ = cls.getDefmapEnviron()
+        check = subprocess.run([python, '-c', 'import importlib.util, sys; '
+                                'sys.exit(not all(importlib.util.find_spec(m) for m in ["tf2onnx", "onnxruntime"]))'],
+                               env=environ, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return check.returncode == 0
+
+    @classmethod
+    def getScriptLocation(cls, step=None):
+        """ Path of the DefMap scripts, models and folders used by the protocols. """
+
+        commonPath = Config.SCIPION_HOME + "/software/em/"+ DEFAULT_SCRIPT_FOLDER
+        specificPath = ""
+
+        if step == "create-dataset-folder":
+            specificPath = "/preprocessing"
+
+        elif step == "inference" :
+            specificPath = "/3dcnn_main.py"
+
+        elif step == "0":
+            specificPath="/model/model_res5A.h5"
+
+        elif step == "1":
+            specificPath="/model/model_res6A.h5"
+
+        elif step == "2":
+            specificPath="/model/model_res7A.h5"
+
+        elif step == "postprocessing-pdb":
+            specificPath = "/postprocessing/rmsf_map2model_for_defmap.py"
+        
+        elif step == "postprocessing-voxel":
+            specificPath = "/postprocessing/rmsf_map2grid.py"
+
+        elif step == "postprocessing-folder":
+            specificPath="/postprocessing"
+
+        elif step == "packed-env":
+            specificPath="/env"
+
+        return commonPath + specificPath
+
+    @classmethod
+    def getCache(cls):
+        """ Cache of datasets and predictions, None if DEFMAP_CACHE_DIR is not set. """
+        folder = cls.getVar(DEFMAP_CACHE_DIR)
+        if not folder:
+            return None
+        return DefmapCache(folder, float(cls.getVar(DEFMAP_CACHE_SIZE)) * 1024 ** 3)
+
+    @classmethod
+    def getTestMap(cls):
+        """ Map bundled with the tests, used to check the exported models. """
+        return os.path.join(os.path.dirname(__file__), 'tests', 'emd_4054.mrc')
+
+    @classmethod
+    def getPluginScript(cls, name):
+        """ Path of a script of this plugin that runs inside the DefMap environment. """
+        return os.path.join(os.path.dirname(__file__), 'scripts', name)
+
+    @classmethod
+    def getWorkerSocket(cls, gpus=''):
+        """ Socket of the inference worker running on the given GPUs. TensorFlow
+        cannot change its GPUs once loaded, so every GPU list has its worker. """
+        socketPath = cls.getVar(DEFMAP_WORKER_SOCKET)
+        if gpus:
+            socketPath += '-gpu' + gpus.replace(',', '_').replace(' ', '')
+        return socketPath
+
+    @classmethod
+    def startInferenceWorker(cls, inferenceScript, models, gpus=''):
+        """ Launch the warm inference worker in the background. It keeps running
+        after the protocol finishes, until it has been idle for DEFMAP_WORKER_TIMEOUT seconds. """
+        socketPath = cls.getWorkerSocket(gpus)
+        python, environ = cls.getDefmapEnviron()
+        command = [python, cls.getPluginScript('defmap_worker.py'),
+                   '--socket', socketPath,
+                   '--script', inferenceScript,
+                   '--idle-timeout', str(cls.getVar(DEFMAP_WORKER_TIMEOUT))]
+        if gpus:
+            command += ['--gpu', gpus]
+        command += ['--models'] + list(models)
+
+        with open(socketPath + '.log', 'a') as log:
+            subprocess.Popen(command, env=environ, cwd=os.path.dirname(inferenceScript),
+                             stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        return socketPath
+
+    @classmethod
+    def getPackedArchives(cls, version):
+        """ Environment and source archives for the offline install of a
+        version, or None if DEFMAP_PACKED_DIR does not have them. """
+        folder = cls.getVar(DEFMAP_PACKED_DIR)
+        if not folder:
+            return None
+        archives = (os.path.join(folder, getPackedEnvArchive(version)),
+                    os.path.join(folder, getPackedSourceArchive()))
+        if not all(os.path.exists(archive) for archive in archives):
+            return None
+        return archives
+
     @classmethod
     def addDefmapPackage(cls, env, version, default=False):
         ENV_NAME = getEnvName(version)
         FLAG = f"defmap_{version}_installed"
 
+        packedArchives = cls.getPackedArchives(version)
+        if packedArchives:
+            cls.addPackedDefmapPackage(env, version, packedArchives, FLAG, default)
+            return
 
         installCmds = [
             cls.getCondaActivationCmd(),
@@ -92,14 +239,16 @@ class Plugin(pwem.Plugin):
             f'conda install -c anaconda numpy=1.23.4 -y &&',
             f'conda install -c conda-forge scikit-learn -y &&',
             f'conda install -c conda-forge matplotlib  -y &&',
-            f'touch {FLAG}'  # Flag installation finished
         ]
+        if pwutils.strToBoolean(str(cls.getVar(DEFMAP_INSTALL_ONNX))):
+            installCmds.append(f'pip install {" ".join(ONNX_PACKAGES)} &&')
+        installCmds.append(f'touch {FLAG}')  # Flag installation finished
 
         envPath = os.environ.get('PATH', "")
         # keep path since conda likely in there
         installEnvVars = {'PATH': envPath} if envPath else None
 
-        branch = "tf29"
+        branch = DEFMAP_BRANCH
         url = "https://github.com/clinfo/DEFMap.git"
 
         if not os.path.exists(os.path.join(pwem.Config.EM_ROOT, ENV_NAME, 'img')):
@@ -122,3 +271,28 @@ class Plugin(pwem.Plugin):
     
     
             
+
+    @classmethod
+    def addPackedDefmapPackage(cls, env, version, archives, flag, default=False):
+        """ Install from a relocatable environment made with "conda pack" and a
+        tarball of the DEFMap sources, without network nor conda. The
+        environment is checked before setting the installation flag. """
+        envArchive, sourceArchive = archives
+        checksums = [archive + '.sha256' for archive in archives if os.path.exists(archive + '.sha256')]
+
+        installCmds = [
+            # checksum files are "<hash>  <archive name>", as written by sha256sum
+            *[f'(cd "{os.path.dirname(checksum)}" && sha256sum -c "{checksum}") &&' for checksum in checksums],
+            f'tar -xzf "{sourceArchive}" --strip-components=1 &&',
+            'rm -rf env && mkdir env &&',
+            f'tar -xzf "{envArchive}" -C env &&',
+            '. env/bin/activate &&',
+            'conda-unpack &&',
+            'python -c "import tensorflow, moleculekit, sklearn" &&',
+            f'touch {flag}'  # Flag installation finished
+        ]
+
+        env.addPackage('defmap', version=version,
+                       tar='void.tgz',
+                       commands=[(" ".join(installCmds), flag)],
+                       default=default)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Content-addressed cache of DefMap datasets and predictions, shared between
+runs and projects. Entries are files named after the hash of everything
+they depend on, and the least recently used ones are evicted when the cache
+grows over its maximum size.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def hashFile(fileName, digest=None):
+    """ Add the contents of a file to a digest (a new sha256 one if not given). """
+    digest = digest or hashlib.sha256()
+    with open(fileName, 'rb') as hashedFile:
+        for block in iter(lambda: hashedFile.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest
+
+
+def hashKey(*parts):
+    """ Key of a cache entry made of previous keys, parameters... """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class DefmapCache:
+    """ Folder with one file per entry. The modification time of an entry is
+    its last use, so eviction removes the oldest ones first. """
+
+    def __init__(self, folder, maxSize):
+        self.folder = folder
+        self.maxSize = maxSize
+        os.makedirs(folder, exist_ok=True)
+
+    def getEntry(self, key, extension):
+        return os.path.join(self.folder, key + extension)
+
+    def get(self, key, fileName):
+        """ Copy the entry into fileName. Return False if it is not in the cache. """
+        entry = self.getEntry(key, os.path.splitext(fileName)[1])
+        try:
+            os.utime(entry)
+            if os.path.exists(fileName):
+                os.remove(fileName)
+            try:
+                os.link(entry, fileName)
+            except OSError:
+                shutil.copyfile(entry, fileName)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def lookup(self, key, extension):
+        """ Path of the entry to read it in place, None if it is not in the cache. """
+        entry = self.getEntry(key, extension)
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return entry
+
+    def put(self, key, fileName):
+        """ Store a copy of fileName, then evict the entries over the size limit. """
+        self.store(key, os.path.splitext(fileName)[1],
+                   lambda temporaryName: shutil.copyfile(fileName, temporaryName))
+
+    def store(self, key, extension, write):
+        """ Store the file written by write(fileName), then evict the entries over the size limit. """
+        temporary, temporaryName = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        os.close(temporary)
+        try:
+            write(temporaryName)
+            os.replace(temporaryName, self.getEntry(key, extension))  # atomic, other runs never see half-written entries
+        finally:
+            if os.path.exists(temporaryName):
+                os.remove(temporaryName)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                status = os.stat(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                continue  # evicted by another run
+            entries.append((status.st_mtime, status.st_size, name))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entrySize, name in sorted(entries):
+            if size <= self.maxSize:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+            size -= entrySize
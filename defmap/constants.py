@@ -40,4 +40,87 @@ def getEnvName(version):
 DEFAULT_ENV_NAME = getEnvName(DEFAULT_VERSION)
 DEFAULT_SCRIPT_FOLDER = getEnvName(DEFAULT_VERSION)
 
+DEFMAP_ENV_CACHE = 'DEFMAP_ENV_CACHE'
+
+# Offline install from archives in a local folder: an environment packed
+# with conda-pack and a tarball of the DEFMap sources
+DEFMAP_PACKED_DIR = 'DEFMAP_PACKED_DIR'
+DEFMAP_INSTALL_ONNX = 'DEFMAP_INSTALL_ONNX'
+DEFMAP_BRANCH = "tf29"
+
+def getPackedEnvArchive(version):
+    return "%s-env.tar.gz" % getEnvName(version)
+
+def getPackedSourceArchive(branch=DEFMAP_BRANCH):
+    return "DEFMap-%s.tar.gz" % branch
+
     
+
+
+# Preprocessing
+
+PREPROCESS_XMIPP = 0
+PREPROCESS_NUMPY = 1
+
+PREPROCESS_SAMPLING = 1.5
+
+
+# Inference worker
+
+DEFMAP_WORKER_SOCKET = 'DEFMAP_WORKER_SOCKET'
+DEFMAP_WORKER_TIMEOUT = 'DEFMAP_WORKER_TIMEOUT'
+
+DEFAULT_WORKER_TIMEOUT = 1800  # seconds idle before the worker exits
+WORKER_START_TIMEOUT = 600  # seconds to wait for TensorFlow and the models to load
+
+
+# Dataset and prediction cache
+
+DEFMAP_CACHE_DIR = 'DEFMAP_CACHE_DIR'
+DEFMAP_CACHE_SIZE = 'DEFMAP_CACHE_SIZE'
+
+DEFAULT_CACHE_SIZE = 50  # GB
+
+
+# Resolution models
+
+RESOLUTION_ALL = 3
+MODEL_SUFFIXES = ['_5A', '_6A', '_7A']
+
+
+# Dataset builder
+
+DATASET_SCRIPT = 0
+DATASET_NUMPY = 1
+
+
+# Voxel visualization writer
+
+VOXELS_SCRIPT = 0
+VOXELS_NUMPY = 1
+
+
+# Mapping of the prediction onto the atoms
+
+MAPPING_SCRIPT = 0
+MAPPING_NEAREST = 1
+MAPPING_RADIUS = 2
+MAPPING_TRILINEAR = 3
+
+
+# Inference device
+
+INFERENCE_GPU = 0
+INFERENCE_CPU = 1
+
+
+# Inference runtime on the CPU
+
+RUNTIME_TENSORFLOW = 0
+RUNTIME_ONNX = 1
+
+ONNX_QUANTIZATIONS = ['none', 'float16', 'int8']
+# ONNX export and runtime, installed with the DefMap environment unless
+# DEFMAP_INSTALL_ONNX is false, with versions that work with tensorflow-gpu 2.4.1
+ONNX_PACKAGES = ['tf2onnx==1.9.3', 'onnx==1.12.0', 'onnxruntime==1.14.1', 'onnxconverter-common==1.13.0',
+                 'protobuf==3.20.1', 'flatbuffers==1.12']
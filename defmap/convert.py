@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Conversion functions between the files used by DefMap and NumPy arrays
+"""
+
+import gzip
+import shlex
+import numpy as np
+from pwem.convert import Ccp4Header
+
+from defmap.scripts.defmap_dataset import MRC_HEADER_SIZE, SLAB_SIZE, readMrcLayout, mapMrc, loadPrediction
+
+# Pseudo-atom of a voxel in a PDB file: serial, residue number, coordinates
+# and B-factor are filled in the columns given below (first column, width)
+PDB_GRID_RECORD = b"ATOM      1  CA  GLY A   1       0.000   0.000   0.000  1.00  0.00           C  \n"
+PDB_SERIAL = (6, 5)
+PDB_ATOM_NAME = (12, 4)
+PDB_RESIDUE_NAME = (17, 3)
+PDB_CHAIN = (21, 1)
+PDB_RESIDUE = (22, 4)
+PDB_INSERTION = (26, 1)
+PDB_COORDINATES = ((30, 8), (38, 8), (46, 8))
+PDB_BFACTOR = (60, 6)
+PDB_CHUNK_SIZE = 100000  # records formatted and written at once
+PDB_RECORD_SIZE = 80
+
+# Columns of the _atom_site loop of mmCIF files read for the alpha carbons,
+# the author ones first as Bio.PDB does
+CIF_ATOM_SITE = '_atom_site.'
+CIF_COLUMNS = {'name': ['auth_atom_id', 'label_atom_id'],
+               'residueName': ['auth_comp_id', 'label_comp_id'],
+               'chain': ['auth_asym_id', 'label_asym_id'],
+               'residue': ['auth_seq_id', 'label_seq_id'],
+               'insertion': ['pdbx_PDB_ins_code'],
+               'bfactor': ['B_iso_or_equiv'],
+               'model': ['pdbx_PDB_model_num']}
+
+# Arrays of the compact prediction files
+VOXELS_COORDINATES = 'coordinates'  # (n, 3) x, y, z in Å
+VOXELS_CENTERS = 'centers'  # (n, 3) z, y, x voxels of the map
+VOXELS_VALUES = 'values'
+VOXELS_SAMPLING = 'samplingRate'
+VOXELS_ORIGIN = 'origin'
+
+
+class MrcVolume:
+    """ Access to an MRC file that only reads the header when created. The
+    voxels are memory mapped, so views of them do not load the volume. """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.header = Ccp4Header(fileName, readHeader=True)
+        self.shape, self.dtype, self.offset = readMrcLayout(fileName)  # shape is nz, ny, nx
+
+    def getDimensions(self):
+        """ Dimensions as x, y, z """
+        return self.shape[::-1]
+
+    def getSamplingRate(self):
+        """ Sampling rate (Å/px) along x, the voxels of the maps are cubic. """
+        return self.header.getSampling()[0]
+
+    def getOrigin(self):
+        return self.header.getOrigin()
+
+    def getData(self, mode='r'):
+        """ Memory map of the voxels with (z, y, x) axes. """
+        return mapMrc(self.fileName, mode=mode)
+
+
+def isMrcFile(fileName):
+    """ Whether the file has the MAP stamp of the MRC/CCP4 format, whatever its extension. """
+    stamp = np.fromfile(fileName, dtype=np.uint8, count=212)[208:212]
+    return bytes(stamp) == b'MAP '
+
+
+def readMrc(fileName, mode='r'):
+    """ Memory map with (z, y, x) axes of the voxels of an MRC file, shared
+    with the scripts of the DefMap environment. """
+    return mapMrc(fileName, mode=mode)
+
+
+def createMrc(fileName, shape, samplingRate, origin=(0.0, 0.0, 0.0)):
+    """ Create a float32 MRC file for a (z, y, x) volume with the given
+    sampling rate (Å/px) and origin (Å), and return a writable memory map of
+    its voxels. Call updateMrcStatistics once the voxels are written. """
+    nz, ny, nx = shape
+
+    header = np.zeros(256, dtype=np.int32)
+    floats = header.view(np.float32)
+
+    header[0:3] = nx, ny, nz
+    header[3] = 2  # float32
+    header[7:10] = nx, ny, nz
+    floats[10:13] = nx * samplingRate, ny * samplingRate, nz * samplingRate
+    floats[13:16] = 90.0
+    header[16:19] = 1, 2, 3
+    header[22] = 1  # volume space group
+    floats[49:52] = origin
+    header[52] = np.frombuffer(b'MAP ', dtype=np.int32)[0]
+    header[53] = np.frombuffer(b'\x44\x44\x00\x00', dtype=np.int32)[0]
+
+    with open(fileName, 'wb') as mrcFile:
+        header.tofile(mrcFile)
+        mrcFile.truncate(MRC_HEADER_SIZE + nx * ny * nz * 4)
+
+    return np.memmap(fileName, dtype=np.float32, mode='r+',
+                     offset=MRC_HEADER_SIZE, shape=tuple(shape))
+
+
+def updateMrcStatistics(fileName):
+    """ Store the minimum, maximum, mean and rms of the voxels in the header,
+    going through the volume slab by slab. NaN voxels (no value) are left out. """
+    data = readMrc(fileName)
+    count = 0
+    minimum, maximum = np.inf, -np.inf
+    total = squares = 0.0
+
+    for z in range(0, data.shape[0], SLAB_SIZE):
+        slab = np.asarray(data[z:z + SLAB_SIZE], dtype=np.float64)
+        slab = slab[~np.isnan(slab)]
+        if not slab.size:
+            continue
+        count += slab.size
+        minimum = min(minimum, slab.min())
+        maximum = max(maximum, slab.max())
+        total += slab.sum()
+        squares += np.square(slab).sum()
+
+    if not count:
+        minimum = maximum = 0.0
+    count = max(count, 1)
+    mean = total / count
+    statistics = np.array([minimum, maximum, mean], dtype=np.float32)
+    rms = np.array([np.sqrt(max(squares / count - mean ** 2, 0.0))], dtype=np.float32)
+
+    with open(fileName, 'r+b') as mrcFile:
+        mrcFile.seek(19 * 4)
+        statistics.tofile(mrcFile)
+        mrcFile.seek(54 * 4)
+        rms.tofile(mrcFile)
+
+
+def writeMrc(fileName, data, samplingRate, origin=(0.0, 0.0, 0.0)):
+    """ Write a (z, y, x) array as a float32 MRC file with the given sampling
+    rate (Å/px) and origin (Å). """
+    output = createMrc(fileName, data.shape, samplingRate, origin)
+    output[:] = data
+    output.flush()
+    del output
+    updateMrcStatistics(fileName)
+
+
+def multiplyMrc(fileName, maskFileName, outputFileName, samplingRate):
+    """ Write the product of two MRC volumes of the same size, slab by slab. """
+    volume = readMrc(fileName)
+    mask = readMrc(maskFileName)
+    output = createMrc(outputFileName, volume.shape, samplingRate)
+
+    for z in range(0, volume.shape[0], SLAB_SIZE):
+        np.multiply(volume[z:z + SLAB_SIZE], mask[z:z + SLAB_SIZE], out=output[z:z + SLAB_SIZE])
+
+    output.flush()
+    del output
+    updateMrcStatistics(outputFileName)
+
+
+def setMrcSamplingRate(fileName, samplingRate):
+    """ Change the sampling rate in the header without touching the voxels. """
+    header = Ccp4Header(fileName, readHeader=True)
+    header.setSampling(samplingRate)
+    header.writeHeader()
+
+
+def formatColumn(values, width, decimals=0):
+    """ Text of the numbers right aligned in a column of the given width, as
+    "%*.*f" % (width, decimals, value) gives for each of them, but formatted
+    all at once. Returns an (n, width) array of bytes. """
+    scaled = np.rint(np.asarray(values, dtype=np.float64) * 10 ** decimals).astype(np.int64)
+    negative = scaled < 0
+    magnitude = np.abs(scaled)
+
+    column = np.full((len(scaled), width), ord(' '), dtype=np.uint8)
+    position = width - 1
+    length = np.ones(len(scaled), dtype=np.int64)  # characters used by each number
+    for digit in range(width):
+        if decimals and digit == decimals:
+            column[:, position] = ord('.')
+            position -= 1
+            length += 1
+        if position < 0:
+            break
+        shown = (magnitude >= 10 ** digit) | (digit <= decimals)
+        column[shown, position] = ord('0') + (magnitude[shown] // 10 ** digit) % 10
+        length[shown] = width - position
+        position -= 1
+
+    length += negative
+    if np.any(length > width) or np.any(magnitude >= 10 ** (width - bool(decimals))):
+        raise Exception('Numbers do not fit in a column of %d characters' % width)
+    rows = np.flatnonzero(negative)
+    column[rows, width - length[rows]] = ord('-')
+    return column
+
+
+def openFile(fileName, mode='rb'):
+    """ Open a file, decompressing or compressing it if its name ends with .gz. """
+    if fileName.endswith('.gz'):
+        return gzip.open(fileName, mode if 'b' in mode else mode + 't')
+    return open(fileName, mode)
+
+
+def writeGridPdb(fileName, coordinates, values, chunkSize=PDB_CHUNK_SIZE):
+    """ Write a PDB file with one pseudo-atom per voxel at the given (x, y, z)
+    coordinates (Å) and the values as B-factors. The records are formatted
+    in chunks as one block of bytes; a .gz file name gives a compressed file. """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+    values = np.asarray(values, dtype=np.float64).ravel()
+    record = np.frombuffer(PDB_GRID_RECORD, dtype=np.uint8)
+
+    with openFile(fileName, 'wb') as pdbFile:
+        for start in range(0, len(values), chunkSize):
+            stop = min(start + chunkSize, len(values))
+            records = np.tile(record, (stop - start, 1))
+            serials = np.arange(start + 1, stop + 1)
+
+            fields = [(PDB_SERIAL, formatColumn(serials % 100000, PDB_SERIAL[1])),
+                      (PDB_RESIDUE, formatColumn(serials % 10000, PDB_RESIDUE[1])),
+                      (PDB_BFACTOR, formatColumn(values[start:stop], PDB_BFACTOR[1], 2))]
+            for axis, column in enumerate(PDB_COORDINATES):
+                fields.append((column, formatColumn(coordinates[start:stop, axis], column[1], 3)))
+
+            for (first, width), text in fields:
+                records[:, first:first + width] = text
+            pdbFile.write(records.tobytes())
+        pdbFile.write(b"END\n")
+
+
+def getVoxelCoordinates(centers, volume):
+    """ (x, y, z) coordinates (Å) of (z, y, x) voxel centers of an MrcVolume. """
+    return np.asarray(volume.getOrigin()) + centers[:, ::-1] * volume.getSamplingRate()
+
+
+def predictionToGridPdb(predictionFileName, mapFileName, fileName):
+    """ Write the voxel visualization of a prediction: the centers of the
+    sub-voxels, placed in the map, with the predicted values as B-factors. """
+    centers, values = loadPrediction(predictionFileName)
+    writeGridPdb(fileName, getVoxelCoordinates(centers, MrcVolume(mapFileName)), values)
+
+
+def predictionToNpz(predictionFileName, mapFileName, fileName):
+    """ Write a prediction as a compressed NumPy file with the coordinates,
+    the voxels and the float32 values of the sub-voxels, and the sampling
+    rate and origin of the map. It has no limits on the number of voxels. """
+    centers, values = loadPrediction(predictionFileName)
+    volume = MrcVolume(mapFileName)
+    np.savez_compressed(fileName, **{
+        VOXELS_COORDINATES: getVoxelCoordinates(centers, volume).astype(np.float32),
+        VOXELS_CENTERS: centers.astype(np.int32),
+        VOXELS_VALUES: values.astype(np.float32),
+        VOXELS_SAMPLING: np.float32(volume.getSamplingRate()),
+        VOXELS_ORIGIN: np.asarray(volume.getOrigin(), dtype=np.float32)})
+
+
+def predictionToMrc(predictionFileName, mapFileName, fileName, samplingRate=None):
+    """ Write a prediction as a float32 volume on the grid of the map, with its
+    origin and sampling rate (the one of its header if not given): the
+    predicted log(RMSF) at the centers of the sub-voxels and NaN in the voxels
+    that were not predicted, as zero is a valid log(RMSF). """
+    centers, values = loadPrediction(predictionFileName)
+    volume = MrcVolume(mapFileName)
+    if samplingRate is None:
+        samplingRate = volume.getSamplingRate()
+    output = createMrc(fileName, volume.shape, samplingRate, volume.getOrigin())
+    output[:] = np.nan
+    output[tuple(centers.T)] = values
+    output.flush()
+    del output
+    updateMrcStatistics(fileName)
+
+
+def readVoxelPredictions(fileName):
+    """ (x, y, z) coordinates (Å) and values of a file of predictionToNpz. """
+    with np.load(fileName) as predictions:
+        return predictions[VOXELS_COORDINATES], predictions[VOXELS_VALUES]
+
+
+def readPdbAtoms(fileName):
+    """ Lines of a PDB file, the indexes of its ATOM and HETATM lines and
+    those lines as an (n, 80) array of bytes, to read and change their
+    columns all at once. """
+    with openFile(fileName) as pdbFile:
+        lines = pdbFile.read().splitlines()
+
+    indexes = [i for i, line in enumerate(lines) if line.startswith((b'ATOM  ', b'HETATM'))]
+    atoms = np.array([lines[i] for i in indexes], dtype='S%d' % PDB_RECORD_SIZE)
+    records = np.full((len(indexes), PDB_RECORD_SIZE), ord(' '), dtype=np.uint8)
+    raw = atoms.view(np.uint8).reshape(len(indexes), PDB_RECORD_SIZE)
+    records[raw != 0] = raw[raw != 0]  # short lines are padded with blanks
+    return lines, indexes, records
+
+
+def getPdbColumn(records, column, dtype=np.float64):
+    """ Values of a (first, width) column of the records of readPdbAtoms. """
+    first, width = column
+    text = np.ascontiguousarray(records[:, first:first + width]).view('S%d' % width).ravel()
+    return text.astype(dtype)
+
+
+def getPdbCoordinates(records):
+    """ (n, 3) array with the x, y, z coordinates (Å) of the records. """
+    return np.stack([getPdbColumn(records, column) for column in PDB_COORDINATES], axis=1)
+
+
+def writePdbBfactors(fileName, lines, indexes, records, values):
+    """ Write the lines of readPdbAtoms with the values as B-factors of the atoms. """
+    first, width = PDB_BFACTOR
+    records = records.copy()
+    records[:, first:first + width] = formatColumn(values, width, 2)
+
+    lines = list(lines)
+    for index, record in zip(indexes, records.view('S%d' % PDB_RECORD_SIZE).ravel()):
+        lines[index] = record
+    with open(fileName, 'wb') as pdbFile:
+        pdbFile.write(b"\n".join(lines) + b"\n")
+
+
+def readPdbColumns(fileName, atomName=None):
+    """ Atom name, residue name, chain, residue number, insertion code and
+    B-factor of the atoms of the first model of a PDB file, as arrays. With
+    an atom name, only those atoms are converted. """
+    lines, indexes, records = readPdbAtoms(fileName)
+    ends = [i for i, line in enumerate(lines) if line.startswith(b'ENDMDL')]
+    if ends:
+        records = records[np.asarray(indexes) < ends[0]]
+
+    if atomName is not None:
+        # the name can be anywhere in its four columns
+        first, width = PDB_ATOM_NAME
+        padded = [(' ' * start + atomName).ljust(width).encode() for start in range(width - len(atomName) + 1)]
+        names = np.ascontiguousarray(records[:, first:first + width]).view('S%d' % width).ravel()
+        records = records[np.isin(names, padded)]
+
+    def text(column):
+        return np.char.strip(getPdbColumn(records, column, 'U%d' % column[1]))
+
+    return (text(PDB_ATOM_NAME), text(PDB_RESIDUE_NAME), text(PDB_CHAIN),
+            getPdbColumn(records, PDB_RESIDUE, np.int64), text(PDB_INSERTION),
+            getPdbColumn(records, PDB_BFACTOR))
+
+
+def readCifColumns(fileName):
+    """ Same arrays as readPdbColumns from the _atom_site loop of an mmCIF file. """
+    names = []
+    tokens = []
+    with openFile(fileName, 'r') as cifFile:
+        for line in cifFile:
+            if line.startswith(CIF_ATOM_SITE):
+                names.append(line.split()[0][len(CIF_ATOM_SITE):])
+            elif names:
+                if line.startswith(('loop_', '_', '#', 'data_')):
+                    break
+                # values with blanks are quoted
+                tokens.extend(shlex.split(line) if '"' in line or "'" in line else line.split())
+
+    rows = np.array(tokens, dtype=str).reshape(-1, len(names) or 1)
+
+    def column(key, default):
+        for name in CIF_COLUMNS[key]:
+            if name in names:
+                return rows[:, names.index(name)]
+        return np.full(len(rows), default)
+
+    models = column('model', '1')
+    first = models == models[0] if len(models) else np.zeros(0, dtype=bool)
+    insertions = column('insertion', '?')
+    insertions[np.isin(insertions, ['?', '.'])] = ''
+
+    return (column('name', '')[first], column('residueName', '')[first], column('chain', '')[first],
+            column('residue', '0')[first].astype(np.int64), insertions[first],
+            column('bfactor', '0')[first].astype(np.float64))
+
+
+def readCaAtoms(fileName):
+    """ Chain, residue name, residue number and B-factor of the alpha carbons
+    of a PDB or mmCIF file, as NumPy arrays. Only the fixed columns of the
+    atoms are read, and only the first alternate location of every atom is
+    kept. Compressed (.gz) files are read too. """
+    with openFile(fileName) as structureFile:
+        isCif = structureFile.read(5) == b'data_' or fileName.endswith(('.cif', '.mmcif', '.cif.gz', '.mmcif.gz'))
+    names, residueNames, chains, residues, insertions, bfactors = \
+        readCifColumns(fileName) if isCif else readPdbColumns(fileName, 'CA')
+
+    alpha = np.flatnonzero(names == 'CA')
+    keys = np.char.add(np.char.add(chains[alpha], '|'), np.char.add(residues[alpha].astype(str), insertions[alpha]))
+    alpha = alpha[np.sort(np.unique(keys, return_index=True)[1])]
+    return chains[alpha], residueNames[alpha], residues[alpha], bfactors[alpha]
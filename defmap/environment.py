@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Resolution of the DefMap conda environment. Activating the environment
+takes seconds on shared filesystems, so it is activated once to find its
+interpreter and the variables that the activation sets, and the result is
+kept in a JSON file until the environment changes (packages installed or
+removed, or another activation command).
+"""
+
+import json
+import os
+import subprocess
+import tempfile
+import threading
+
+# Printed after the activation, to tell the result from the output of the activation scripts
+RESOLVE_SCRIPT = ("import json, os, sys; "
+                  "print(); print(json.dumps({'python': sys.executable, 'environ': dict(os.environ)}))")
+
+lock = threading.Lock()
+
+
+def getStamp(prefix):
+    """ Modification times that change when packages are installed in or removed from the environment. """
+    stamp = []
+    for name in ['conda-meta', os.path.join('bin', 'python')]:
+        fileName = os.path.join(prefix, name)
+        stamp.append(os.stat(fileName).st_mtime_ns if os.path.exists(fileName) else None)
+    return stamp
+
+
+def resolveEnvironment(activationCommand, environ):
+    """ Interpreter of the environment and changes of the activation to the given variables. """
+    result = subprocess.run(['bash', '-c', '%s && python -c "%s"' % (activationCommand, RESOLVE_SCRIPT)],
+                            env=environ, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    lines = result.stdout.decode(errors='replace').strip().splitlines()
+    if result.returncode or not lines:
+        raise Exception('The DefMap environment could not be activated:\n%s' % result.stderr.decode(errors='replace'))
+    activated = json.loads(lines[-1])
+    python, activated = activated['python'], activated['environ']
+
+    changed, prepended = {}, {}
+    for name, value in activated.items():
+        before = environ.get(name)
+        if value == before:
+            continue
+        if before and value.endswith(before):
+            prepended[name] = value[:-len(before)]  # e.g. PATH, keep what follows when applied
+        else:
+            changed[name] = value
+    removed = [name for name in environ if name not in activated]
+
+    prefix = activated.get('CONDA_PREFIX', os.path.dirname(os.path.dirname(python)))
+    return {'activation': activationCommand, 'prefix': prefix, 'stamp': getStamp(prefix), 'python': python,
+            'changed': changed, 'prepended': prepended, 'removed': removed}
+
+
+def isValid(resolved, activationCommand):
+    return (resolved.get('activation') == activationCommand and os.path.exists(resolved['python'])
+            and resolved['stamp'] == getStamp(resolved['prefix']))
+
+
+def applyEnvironment(resolved, environ):
+    """ Variables to run a program of the environment, from the current ones. """
+    environ = dict(environ)
+    for name in resolved['removed']:
+        environ.pop(name, None)
+    for name, value in resolved['prepended'].items():
+        environ[name] = value + environ.get(name, '')
+    environ.update(resolved['changed'])
+    return environ
+
+
+def getEnvironment(cacheFile, activationCommand, environ):
+    """ Interpreter of the environment and the variables to run it, resolved
+    with the activation command only when the cache file is missing or out
+    of date. """
+    with lock:
+        resolved = None
+        if os.path.exists(cacheFile):
+            try:
+                with open(cacheFile) as resolvedFile:
+                    resolved = json.load(resolvedFile)
+                if not isValid(resolved, activationCommand):
+                    resolved = None
+            except (ValueError, KeyError, OSError):
+                resolved = None
+
+        if resolved is None:
+            resolved = resolveEnvironment(activationCommand, environ)
+            folder = os.path.dirname(cacheFile) or '.'
+            os.makedirs(folder, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            with os.fdopen(descriptor, 'w') as resolvedFile:
+                json.dump(resolved, resolvedFile, indent=2)
+            os.replace(temporary, cacheFile)
+
+    return resolved['python'], applyEnvironment(resolved, environ)
+
+
+def getCpuEnviron(threads):
+    """ Variables to run TensorFlow on the CPU with the given number of
+    threads. They all go to the intra-op pool, as the layers of the models
+    run one after the other and a bigger inter-op pool only oversubscribes. """
+    return {'CUDA_VISIBLE_DEVICES': '-1',
+            'TF_NUM_INTRAOP_THREADS': str(threads),
+            'TF_NUM_INTEROP_THREADS': '1',
+            'OMP_NUM_THREADS': str(threads)}
+
+
+def parseCpuList(cpuList):
+    """ Cores of a list like "0-3,8,10-11", as taskset takes them. """
+    cores = set()
+    for part in cpuList.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cores.update(range(int(first), int(last or first) + 1))
+    return sorted(cores)
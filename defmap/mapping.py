@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Mapping of the voxel predictions of DefMap onto the atoms of a structure.
+The predicted voxels are indexed once in a KD-tree and the neighbourhoods
+of all the atoms are queried in a single batch.
+"""
+
+import itertools
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from defmap.constants import MAPPING_NEAREST, MAPPING_RADIUS, MAPPING_TRILINEAR
+from defmap.convert import MrcVolume, readPdbAtoms, getPdbCoordinates, writePdbBfactors
+from defmap.scripts.defmap_dataset import loadPrediction
+
+CORNERS = np.array(list(itertools.product((0, 1), repeat=3)))
+
+
+def countNeighbours(radius):
+    """ Most grid points that can be within the radius (in voxels) of a point. """
+    reach = int(np.ceil(radius)) + 1
+    offsets = np.array(list(itertools.product(range(-reach, reach + 1), repeat=3)))
+    # the point can be anywhere in its voxel, so take the half diagonal as margin
+    return int(np.count_nonzero(np.linalg.norm(offsets, axis=1) <= radius + np.sqrt(3)))
+
+
+def nearestValues(tree, values, points, workers=1):
+    _, neighbours = tree.query(points, workers=workers)
+    return values[neighbours]
+
+
+def radiusValues(tree, values, points, radius, workers=1):
+    """ Mean of the values within the radius of each point, or the nearest value
+    if there is none. """
+    distances, neighbours = tree.query(points, k=min(countNeighbours(radius), len(values)),
+                                       distance_upper_bound=radius, workers=workers)
+    distances = distances.reshape(len(points), -1)
+    neighbours = neighbours.reshape(len(points), -1)
+
+    found = np.isfinite(distances)
+    counts = found.sum(axis=1)
+    sums = np.where(found, values[np.minimum(neighbours, len(values) - 1)], 0.0).sum(axis=1)
+
+    result = nearestValues(tree, values, points, workers)
+    np.divide(sums, counts, out=result, where=counts > 0)
+    return result
+
+
+def trilinearValues(tree, values, points, workers=1):
+    """ Trilinear interpolation between the predicted voxels around each point.
+    Missing corners are left out, and the nearest value is used if all of them
+    are missing. """
+    base = np.floor(points)
+    fractions = points - base
+
+    corners = base[:, None, :] + CORNERS[None, :, :]
+    weights = np.prod(np.where(CORNERS[None, :, :] == 1, fractions[:, None, :], 1.0 - fractions[:, None, :]),
+                      axis=2)
+
+    _, neighbours = tree.query(corners.reshape(-1, 3), distance_upper_bound=0.5, workers=workers)
+    neighbours = neighbours.reshape(len(points), len(CORNERS))
+    found = neighbours < len(values)
+    weights = np.where(found, weights, 0.0)
+    sums = (weights * values[np.minimum(neighbours, len(values) - 1)]).sum(axis=1)
+    totals = weights.sum(axis=1)
+
+    result = nearestValues(tree, values, points, workers)
+    np.divide(sums, totals, out=result, where=totals > 0)
+    return result
+
+
+def mapToAtoms(centers, values, points, method=MAPPING_NEAREST, radius=1.0, workers=1):
+    """ Value of the predicted voxels at each point. Centers and points are
+    (z, y, x) positions in voxels and the radius is given in voxels too. The
+    queries run in the given number of threads. """
+    values = np.asarray(values, dtype=np.float64)
+    tree = cKDTree(np.asarray(centers, dtype=np.float64))
+    points = np.asarray(points, dtype=np.float64)
+
+    if method == MAPPING_RADIUS:
+        return radiusValues(tree, values, points, radius, workers)
+    elif method == MAPPING_TRILINEAR:
+        return trilinearValues(tree, values, points, workers)
+    return nearestValues(tree, values, points, workers)
+
+
+def predictionToModel(predictionFileName, mapFileName, structureFileName, fileName,
+                      method=MAPPING_NEAREST, radius=1.5, normalize=True, workers=1):
+    """ Write the structure with the prediction mapped onto its atoms as
+    B-factors, as "rmsf_map2model_for_defmap.py" does. The radius is in Å and
+    the values are standardized over the atoms when normalize is set. """
+    centers, values = loadPrediction(predictionFileName)
+    volume = MrcVolume(mapFileName)
+    samplingRate = volume.getSamplingRate()
+
+    lines, indexes, records = readPdbAtoms(structureFileName)
+    positions = (getPdbCoordinates(records) - np.asarray(volume.getOrigin())) / samplingRate
+    atomValues = mapToAtoms(centers, values, positions[:, ::-1], method, radius / samplingRate, workers)
+
+    if normalize and len(atomValues) > 1:
+        atomValues = (atomValues - atomValues.mean()) / (atomValues.std() or 1.0)
+    writePdbBfactors(fileName, lines, indexes, records, atomValues)
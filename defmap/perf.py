@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Instrumentation of the protocol steps. Every measured step records its wall
+time, the CPU time of the protocol and of its child processes (runJob,
+xmipp programs...) and the peak memory, in a JSON file of the run.
+
+The resident memory of the protocol and of its child processes is sampled
+while the step runs, as the system only keeps the high-water mark of the
+whole life of a process. Where /proc is not available, the high-water marks
+are recorded instead and the measure says so.
+"""
+
+import functools
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+PERF_FILE = 'perf.json'
+SAMPLE_INTERVAL = 0.2  # seconds between memory samples
+
+# ru_maxrss is given in KB on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+lock = threading.Lock()
+
+
+def getUsage():
+    return resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def readRss(pid):
+    """ Resident memory (bytes) of a process, 0 if it is gone. """
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def getDescendants(pid):
+    """ Pids of the child processes of a process and of their children. """
+    parents = {}
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open('/proc/%s/stat' % name) as stat:
+                    # the parent comes after the command name, which can have blanks
+                    parents[int(name)] = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                pass
+
+    descendants = []
+    pending = [pid]
+    while pending:
+        parent = pending.pop()
+        children = [child for child, childParent in parents.items() if childParent == parent]
+        descendants.extend(children)
+        pending.extend(children)
+    return descendants
+
+
+class MemorySampler:
+    """ Peak resident memory of the process and of all its child processes
+    together, sampled every SAMPLE_INTERVAL seconds between start and stop.
+    Child processes shorter than the interval can be missed. """
+
+    def __init__(self):
+        self.peakRss = self.childPeakRss = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    @staticmethod
+    def isAvailable():
+        return os.path.exists('/proc/self/status')
+
+    def sample(self):
+        pid = os.getpid()
+        self.peakRss = max(self.peakRss, readRss(pid))
+        self.childPeakRss = max(self.childPeakRss, sum(readRss(child) for child in getDescendants(pid)))
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+
+def getMeasure(start, before, after, sampler=None):
+    """ Measure of a step from the time and the resource usage at its start and end.
+    With a stopped MemorySampler, the peak memory is the one sampled during the
+    step. Otherwise it is the high-water mark of the process (and of its
+    biggest child) so far, and 'cumulativePeaks' is set. With steps running in
+    parallel, the CPU times and the sampled peaks include the overlapping steps. """
+    (selfBefore, childrenBefore), (selfAfter, childrenAfter) = before, after
+    measure = {'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)),
+               'wall': time.time() - start,
+               'cpuUser': selfAfter.ru_utime - selfBefore.ru_utime,
+               'cpuSystem': selfAfter.ru_stime - selfBefore.ru_stime,
+               'childCpuUser': childrenAfter.ru_utime - childrenBefore.ru_utime,
+               'childCpuSystem': childrenAfter.ru_stime - childrenBefore.ru_stime}
+    if sampler is not None:
+        measure.update(peakRss=sampler.peakRss, childPeakRss=sampler.childPeakRss)
+    else:
+        measure.update(peakRss=selfAfter.ru_maxrss * RSS_UNIT, childPeakRss=childrenAfter.ru_maxrss * RSS_UNIT,
+                       cumulativePeaks=True)
+    return measure
+
+
+def readMeasures(fileName):
+    """ Measures of the steps of a run, by step name. """
+    if not os.path.exists(fileName):
+        return {}
+    with open(fileName) as perfFile:
+        return json.load(perfFile)
+
+
+def writeMeasure(fileName, step, measure):
+    """ Add the measure of a step to the file, replacing the one of a previous execution. """
+    with lock:
+        measures = readMeasures(fileName)
+        measures[step] = measure
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(fileName) or '.', suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as perfFile:
+            json.dump(measures, perfFile, indent=2)
+        os.replace(temporary, fileName)
+
+
+def measureStep(step):
+    """ Decorator of the step functions of a protocol that writes their
+    measures to extra/perf.json. The arguments of the step are part of its
+    name, so steps run once per model are told apart. """
+    @functools.wraps(step)
+    def measuredStep(protocol, *args, **kwargs):
+        name = '_'.join([step.__name__] + [str(arg).strip('_') for arg in args if str(arg)])
+        sampler = MemorySampler() if MemorySampler.isAvailable() else None
+        if sampler is not None:
+            sampler.start()
+        start, before = time.time(), getUsage()
+        try:
+            return step(protocol, *args, **kwargs)
+        finally:
+            after = getUsage()
+            if sampler is not None:
+                sampler.stop()
+            writeMeasure(protocol._getExtraPath(PERF_FILE), name, getMeasure(start, before, after, sampler))
+    return measuredStep
+
+
+def summarizeMeasures(measures):
+    """ Lines of a table with the measures of the steps, in execution order. """
+    lines = ['%-24s %10s %10s %14s %10s %16s' % ('Step', 'Wall (s)', 'CPU (s)', 'Child CPU (s)',
+                                                  'Peak (MB)', 'Child peak (MB)')]
+    for step, measure in sorted(measures.items(), key=lambda item: item[1]['start']):
+        lines.append('%-24s %10.1f %10.1f %14.1f %10.0f %16.0f%s' % (
+            step, measure['wall'], measure['cpuUser'] + measure['cpuSystem'],
+            measure['childCpuUser'] + measure['childCpuSystem'],
+            measure['peakRss'] / 1024 ** 2, measure['childPeakRss'] / 1024 ** 2,
+            ' (high-water marks so far)' if measure.get('cumulativePeaks') else ''))
+    return lines
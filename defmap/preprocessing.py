@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+In-process version of the Xmipp preprocessing chain of DefMap. Every
+operation mirrors one of the xmipp programs run by the protocol, but works
+on the volume kept in memory.
+
+The preprocessing is split into stages, and the results of the stages that
+do not depend on the resolution or the threshold (the cropped volume and its
+Fourier transform) can be kept in a DefmapCache for the next runs.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+from defmap.constants import PREPROCESS_SAMPLING
+from defmap.convert import readMrc, writeMrc
+from defmap.cache import hashFile, hashKey
+
+
+def digitalFrequencies(shape):
+    """ Module of the digital frequency (0.5 is Nyquist) of every coefficient
+    of the real FFT of a volume with the given shape. """
+    fz = np.fft.fftfreq(shape[0]).astype(np.float32)[:, None, None]
+    fy = np.fft.fftfreq(shape[1]).astype(np.float32)[None, :, None]
+    fx = np.fft.rfftfreq(shape[2]).astype(np.float32)[None, None, :]
+    return np.sqrt(fz ** 2 + fy ** 2 + fx ** 2)
+
+
+def fourierLowPass(fourier, shape, cutoff, raisedWidth=0.02):
+    """ Low pass filter of the real FFT of a volume with the given shape. The
+    frequencies are kept up to the cutoff and then fall to zero following a
+    raised cosine of the given width. """
+    filter = np.clip((digitalFrequencies(shape) - cutoff) / raisedWidth, 0.0, 1.0)
+    filter = 0.5 * (1.0 + np.cos(np.pi * filter))
+    return np.fft.irfftn(fourier * filter, s=shape).astype(np.float32)
+
+
+def lowPassFilter(volume, cutoff, raisedWidth=0.02):
+    """ Same as xmipp_transform_filter --fourier low_pass cutoff raisedWidth. """
+    return fourierLowPass(np.fft.rfftn(volume), volume.shape, cutoff, raisedWidth)
+
+
+def resizeVolume(volume, factor):
+    """ Same as xmipp_image_resize --factor: cubic spline resampling of the volume. """
+    return ndimage.zoom(volume, factor, order=3).astype(np.float32)
+
+
+def createMask(volume, threshold, minSize=50):
+    """ Binary mask of the protein, as the xmipp chain binarize, removeSmall,
+    keepBiggest and dilation. """
+    mask = volume >= threshold
+
+    labels, _ = ndimage.label(mask)
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+
+    biggest = np.argmax(sizes)
+    if sizes[biggest] < minSize:
+        return np.zeros(volume.shape, dtype=bool)
+
+    neighbourhood = ndimage.generate_binary_structure(3, 2)
+    return ndimage.binary_dilation(labels == biggest, structure=neighbourhood)
+
+
+def cachedStage(cache, key, extension, compute, save, load):
+    """ Result of a preprocessing stage, read from the cache if it was already
+    computed. New results are stored when there is a cache. """
+    if cache is not None:
+        entry = cache.lookup(key, extension)
+        if entry is not None:
+            return load(entry)
+
+    result = compute()
+    if cache is not None:
+        cache.store(key, extension, lambda fileName: save(fileName, result))
+    return result
+
+
+def saveArray(fileName, array):
+    with open(fileName, 'wb') as arrayFile:
+        np.save(arrayFile, array)
+
+
+def loadArray(fileName):
+    return np.load(fileName, mmap_mode='r')
+
+
+def saveVolume(fileName, volume):
+    writeMrc(fileName, volume, PREPROCESS_SAMPLING)
+
+
+def cropKey(volumeKey, samplingRate):
+    """ Cache key of the cropped and resized volume: it only depends on the map and its sampling rate. """
+    return hashKey('numpy-crop', volumeKey, samplingRate)
+
+
+def preprocessVolume(inputFile, outputFile, samplingRate, resolution, threshold=0.0,
+                     cache=None, volumeKey=None, maskFile=None):
+    """ Run the whole preprocessing of DefMap over the map in inputFile and
+    write only the final volume, sampled at 1.5 Å/px, to outputFile, and the
+    protein mask to maskFile if given.
+
+    With a cache, volumeKey identifies the contents of inputFile (its hash is
+    computed if not given). """
+
+    if cache is not None and volumeKey is None:
+        volumeKey = hashFile(inputFile).hexdigest()
+    croppedKey = cropKey(volumeKey, samplingRate)
+    filteredKey = hashKey('numpy-filter', croppedKey, resolution)
+
+    # crop and resize
+    cropped = cachedStage(cache, croppedKey, '.mrc',
+                          lambda: resizeVolume(lowPassFilter(readMrc(inputFile), samplingRate / 3.0),
+                                               samplingRate / PREPROCESS_SAMPLING),
+                          saveVolume, readMrc)
+
+    # filter to the resolution of the model, reusing the transform of the cropped volume
+    def filterVolume():
+        fourier = cachedStage(cache, hashKey('numpy-fourier', croppedKey), '.npy',
+                              lambda: np.fft.rfftn(cropped).astype(np.complex64),
+                              saveArray, loadArray)
+        return fourierLowPass(fourier, cropped.shape, PREPROCESS_SAMPLING / resolution, PREPROCESS_SAMPLING / 100)
+
+    volume = np.array(cachedStage(cache, filteredKey, '.mrc', filterVolume, saveVolume, readMrc))
+
+    # apply mask and drop negative values
+    mask = createMask(volume, threshold)
+    volume *= mask
+    np.maximum(volume, 0.0, out=volume)
+
+    if maskFile is not None:
+        writeMrc(maskFile, mask.astype(np.float32), PREPROCESS_SAMPLING)
+
+    writeMrc(outputFile, volume, PREPROCESS_SAMPLING)
@@ -5,4 +5,5 @@
 # **************************************************************************
 
 from .protocol_def_map import DefMapNeuralNetwork
+from .protocol_def_map_batch import DefMapNeuralNetworkBatch
 from .protocol_test_viewer import DefmapTestViewer
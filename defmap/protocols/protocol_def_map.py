@@ -32,14 +32,25 @@ Protocol to run DefMap neural network
 
 from pyworkflow.protocol import Protocol, params, constants
 from pyworkflow.utils import Message, logger
-from os import path, rename, readlink, symlink
-from pyworkflow import Config
+from os import path, rename, readlink, symlink, makedirs
+from shutil import rmtree
+import shlex
+import json
 from defmap import Plugin
 from defmap.constants import *
-from pwem.objects import AtomStruct, Volume, Transform
+from pwem.objects import AtomStruct, Volume, EMFile
 from pwem.convert.atom_struct import cifToPdb, AtomicStructHandler
 from pwem.emlib.image import ImageHandler
 from pwem.convert import Ccp4Header
+from defmap.preprocessing import preprocessVolume
+from defmap.convert import MrcVolume, isMrcFile, multiplyMrc, setMrcSamplingRate, readMrc, \
+    predictionToGridPdb, predictionToNpz, predictionToMrc
+from defmap.scripts.defmap_worker import isWorkerRunning, waitForWorker, sendRequest
+from defmap.cache import hashFile, hashKey
+from defmap.mapping import predictionToModel
+from defmap.environment import parseCpuList
+from defmap.perf import PERF_FILE, measureStep, readMeasures, summarizeMeasures
+from defmap.scripts.defmap_dataset import CHUNK_SIZE, buildDataset
 
 try:
     from xmipp3 import Plugin as xmipp3Plugin
@@ -54,8 +65,19 @@ class DefMapNeuralNetwork(Protocol):
     def getClassPackageName(cls):
         return "defmap"
 
+    def __init__(self, **kwargs):
+        Protocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = constants.STEPS_PARALLEL
+
     _label = 'Defmap prediction'
-    _possibleOutputs = {'outputStructure': AtomStruct, 'outputStructureVoxel':AtomStruct, 'outputVolume':Volume}
+    _possibleOutputs = {'outputStructure': AtomStruct, 'outputStructureVoxel':AtomStruct, 'outputVolume':Volume,
+                        'outputStructure5A': AtomStruct, 'outputStructureVoxel5A': AtomStruct,
+                        'outputStructure6A': AtomStruct, 'outputStructureVoxel6A': AtomStruct,
+                        'outputStructure7A': AtomStruct, 'outputStructureVoxel7A': AtomStruct,
+                        'outputPredictions': EMFile, 'outputPredictions5A': EMFile,
+                        'outputPredictions6A': EMFile, 'outputPredictions7A': EMFile,
+                        'outputFlexibility': Volume, 'outputFlexibility5A': Volume,
+                        'outputFlexibility6A': Volume, 'outputFlexibility7A': Volume}
 
     # -------------------------- INPUT PARAMETERS ----------------------
     def _defineParams(self, form):
@@ -90,13 +112,25 @@ class DefMapNeuralNetwork(Protocol):
 
         form.addParam('inputResolution', params.EnumParam,
                       label='Resolution',
-                      help='Resolution model for the inference step. There are three models according to three possible resolutions.',
-                      default=0, choices=["5 Å","6 Å","7 Å"]),
+                      help='Resolution model for the inference step. There are three models according to three possible resolutions.\n'
+                           'With "All models" the dataset is created once and the three models run in the same session. '
+                           'Each model gives its own outputs and the main outputs are the average of the three. '
+                           'The volumes are preprocessed to 5 Å in this case.',
+                      default=0, choices=["5 Å","6 Å","7 Å","All models"]),
         
         form.addParam('inputPreprocess', params.BooleanParam, default=False,
-                      condition=haveXmipp,
                       label='Whether to preprocess the volumes',
                       help="In case you want to preprocess, it will change the sampling rate to 1.5 A and the resolution to the one selected.")  
+
+        form.addParam('preprocessEngine', params.EnumParam,
+                      default=PREPROCESS_XMIPP if haveXmipp else PREPROCESS_NUMPY,
+                      condition='inputPreprocess == True',
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Preprocessing engine',
+                      help='Xmipp runs one xmipp program per operation and writes every intermediate volume.\n'
+                           'NumPy loads the map once and does the whole preprocessing in memory, '
+                           'writing only the final volume.',
+                      choices=["Xmipp", "NumPy"])
         
         form.addParam('inputThreshold', params.FloatParam,
                         allowsNull=True, important = False,
@@ -105,28 +139,170 @@ class DefMapNeuralNetwork(Protocol):
                         help='Top threshold to drop voxels with a standardized intensity.\n'
                               'If not given, a threshold of 0 will be used for preprocessing.')
         
+        form.addParam('inferenceDevice', params.EnumParam, default=INFERENCE_GPU,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Inference device',
+                      help='GPU runs the models on the GPUs given in the GPU list.\n'
+                           'CPU hides the GPUs and runs the models with as many TensorFlow threads as '
+                           'threads of the protocol.',
+                      choices=["GPU", "CPU"])
+
+        form.addParam('cpuList', params.StringParam, default='',
+                      condition='inferenceDevice == %d' % INFERENCE_CPU,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='CPU cores',
+                      help='Cores to pin the inference to, as taskset takes them (e.g. 0-7,16-23). '
+                           'Give different cores to runs sharing a node. Leave it empty to let the '
+                           'system place the threads.')
+
+        form.addParam('inferenceRuntime', params.EnumParam, default=RUNTIME_TENSORFLOW,
+                      condition='inferenceDevice == %d' % INFERENCE_CPU,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Inference runtime',
+                      help='TensorFlow runs the Keras models of DefMap.\n'
+                           'ONNX Runtime runs ONNX exports of the models, without loading TensorFlow. '
+                           'Every model is exported once, and checked against TensorFlow on the map of the tests. '
+                           'The ONNX packages are installed in the DefMap environment the first time.',
+                      choices=["TensorFlow", "ONNX Runtime"])
+
+        form.addParam('onnxQuantization', params.EnumParam, default=0,
+                      condition='inferenceDevice == %d and inferenceRuntime == %d' % (INFERENCE_CPU, RUNTIME_ONNX),
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Quantization of the ONNX models',
+                      help='float16 halves the size of the weights and int8 quantizes them dynamically, '
+                           'which is faster on most CPUs. The export fails if the predictions differ too much '
+                           'from the ones of TensorFlow.',
+                      choices=["None (float32)", "float16", "int8"])
+
+        form.addParam('batchSize', params.IntParam, default=0,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Batch size',
+                      help='Sub-voxels predicted at once by the models. Use 0 to choose it from the free '
+                           'memory of the GPU (or of the computer on CPU); the batch is halved whenever it '
+                           'runs out of memory.')
+
+        form.addParam('useInferenceWorker', params.BooleanParam, default=False,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Use warm inference worker',
+                      help='Run the inference in a long-lived worker that keeps TensorFlow and the three '
+                           'models loaded between runs. The worker is started if it is not running and '
+                           'shuts down after being idle (DEFMAP_WORKER_TIMEOUT seconds). '
+                           'It is not used with "All models", which already runs in one session, '
+                           'nor on the CPU, as the threads of its TensorFlow are already set, '
+                           'nor with resumable inference.')
+
+        form.addParam('useCache', params.BooleanParam, default=True,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Use dataset and prediction cache',
+                      help='Reuse the dataset and the prediction of a previous run with the same volume, '
+                           'preprocessing and model. Only available when DEFMAP_CACHE_DIR is set in the '
+                           'Scipion config; the cache is limited to DEFMAP_CACHE_SIZE GB.')
+
         # form.addParam('inputRunNeuralNetwork', params.BooleanParam, default=True,
         #               condition='inputPreprocess == True',
         #               label='Would you like to run also the neural network?',
         #               help="Whether to only preprocess the volumes or also run the neural network")  
 
+        form.addParam('datasetBuilder', params.EnumParam, default=DATASET_SCRIPT,
+                      condition='streamDataset == False',
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Dataset builder',
+                      help='prep_dataset.py runs the DefMap script in its conda environment.\n'
+                           'NumPy extracts and standardizes the sub-voxels inside Scipion with strided views '
+                           'of the memory mapped volume and writes the same sample.jbl.',
+                      choices=["prep_dataset.py", "NumPy"])
+
+        form.addParam('streamDataset', params.BooleanParam, default=False,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Stream sub-voxels to the inference',
+                      help='Extract the sub-voxels of the map in chunks and feed them straight to the models, '
+                           'without creating sample.jbl. The memory used depends on the chunk size instead '
+                           'of the size of the map. The warm inference worker is not used in this mode.')
+
+        form.addParam('chunkSize', params.IntParam, default=CHUNK_SIZE,
+                      condition='streamDataset == True or resumableInference == True',
+                      validators=[params.GT(0)],
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Sub-voxels per chunk',
+                      help='Number of sub-voxels extracted and predicted at once.')
+
+        form.addParam('tileSize', params.IntParam, default=0,
+                      condition='streamDataset == True',
+                      validators=[params.GE(0)],
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Tile size (voxels)',
+                      help='Split the map in tiles of this size, with halos for the sub-voxels of their borders, '
+                           'and predict them in as many processes as threads on the CPU, or one after another on '
+                           'the GPU. The predictions of the tiles are stitched into one. '
+                           'Use 0 to predict the whole map at once.')
+
+        form.addParam('resumableInference', params.BooleanParam, default=False,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Resumable inference',
+                      help='Write the predictions of every chunk of sub-voxels to a numbered shard as soon as '
+                           'they are done. When the protocol is continued after the inference was interrupted, '
+                           'the shards already written are not predicted again. The shards are merged into '
+                           'the prediction at the end.')
+
+        form.addParam('voxelWriter', params.EnumParam, default=VOXELS_SCRIPT,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Voxel visualization writer',
+                      help='rmsf_map2grid.py runs the DefMap script in its conda environment.\n'
+                           'NumPy writes the pseudo-atoms of the voxels inside Scipion, formatting them '
+                           'in large blocks instead of line by line.',
+                      choices=["rmsf_map2grid.py", "NumPy"])
+
+        form.addParam('compressVoxels', params.BooleanParam, default=False,
+                      condition='voxelWriter == %d' % VOXELS_NUMPY,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Compress voxel visualization',
+                      help='Write the voxel visualization as .pdb.gz. It is several times smaller '
+                           'for big maps, but not every viewer opens compressed files.')
+
+        form.addParam('atomMapping', params.EnumParam, default=MAPPING_SCRIPT,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Mapping of the prediction onto the atoms',
+                      help='rmsf_map2model_for_defmap.py runs the DefMap script in its conda environment.\n'
+                           'The other options index the predicted voxels in a KD-tree inside Scipion and '
+                           'query all the atoms at once, taking the nearest voxel, the mean of the voxels '
+                           'within a radius or a trilinear interpolation of the voxels around the atom. '
+                           'The values are standardized over the atoms, as the script does.',
+                      choices=["rmsf_map2model_for_defmap.py", "Nearest voxel", "Mean within radius", "Trilinear"])
+
+        form.addParam('mappingRadius', params.FloatParam, default=1.5,
+                      condition='atomMapping == %d' % MAPPING_RADIUS,
+                      expertLevel=constants.LEVEL_ADVANCED,
+                      label='Mapping radius (Å)',
+                      help='Voxels closer than this distance to an atom are averaged. '
+                           'Atoms without voxels in the radius take the value of the nearest one.')
+
+        form.addParallelSection(threads=1, mpi=0)
+
     # --------------------------- STEPS ------------------------------
     def _insertAllSteps(self):
-        self._insertFunctionStep('validateFormats')
+        stepId = self._insertFunctionStep('validateFormats')
+        inferencePrerequisites = []
+        if self.isOnnxRuntime():
+            # the models are exported while the map is prepared
+            inferencePrerequisites.append(self._insertFunctionStep('exportModelsStep', prerequisites=[stepId]))
         if self.inputPreprocess:
-            self._insertFunctionStep('preprocess')
+            stepId = self._insertFunctionStep('preprocess', prerequisites=[stepId])
         #if self.inputRunNeuralNetwork:
-        self._insertFunctionStep('createDatasetStep')
-        self._insertFunctionStep('inferenceStep')
-        self._insertFunctionStep('postprocStepVoxel')
-        self._insertFunctionStep('postprocStepPdb')
-        self._insertFunctionStep('createOutputStep')
+        if not self.streamDataset:
+            stepId = self._insertFunctionStep('createDatasetStep', prerequisites=[stepId])
+        inferenceId = self._insertFunctionStep('inferenceStep', prerequisites=[stepId] + inferencePrerequisites)
+
+        # postprocessing steps only read the prediction, so they can run in parallel
+        postprocIds = []
+        for suffix in self.getPredictionSuffixes():
+            postprocIds.append(self._insertFunctionStep('postprocStepVoxel', suffix, prerequisites=[inferenceId]))
+            postprocIds.append(self._insertFunctionStep('postprocStepPdb', suffix, prerequisites=[inferenceId]))
+        self._insertFunctionStep('createOutputStep', prerequisites=postprocIds)
         
 
+    @measureStep
     def validateFormats(self):
 
-        self.resultsFolder = path.abspath(self.getWorkingDir()) + "/extra"
-
         # validate volumes
 
         volumesName = self.inputVolume.get().getFileName()
@@ -146,16 +322,40 @@ class DefMapNeuralNetwork(Protocol):
             else:
                 raise Exception('The extension of the atomic structure is not suported')
             
+    @measureStep
     def preprocess(self):
 
+        if self.preprocessEngine.get() == PREPROCESS_NUMPY:
+            self.preprocessInProcess()
+            return
+
         self.cropResizeVolumes()
         self.filterVolumes()
         self.create3dMask()
         self.apply3dMask()
         self.volumesThreshold()
 
+    @measureStep
     def createDatasetStep(self):
 
+        cache = self.getCache()
+        if cache is not None and cache.get(self.getDatasetKey(), self.getResult('dataset')):
+            logger.info("Dataset found in the cache")
+            return
+
+        if self.datasetBuilder.get() == DATASET_NUMPY:
+            mask = self.getMask()
+            count = buildDataset(readMrc(self.getMap()), self.getResult('dataset'),
+                                 mask=readMrc(mask) if mask else None)
+            logger.info("Dataset of %d sub-voxels created" % count)
+        else:
+            self.runCreateDataset()
+
+        if cache is not None:
+            cache.put(self.getDatasetKey(), self.getResult('dataset'))
+
+    def runCreateDataset(self):
+
         # Set arguments to create-dataset command
         
         args = [
@@ -169,13 +369,34 @@ class DefMapNeuralNetwork(Protocol):
             args.append('-m "%s" ' % self.getResult('volumes'))
 
         # Execute create-dataset
-        createDatasetCommand ="python prep_dataset.py"
-        
-        self._enterDir(self.getScriptLocation("create-dataset-folder"))
-        self.runJob(Plugin.getEnvActivationCommand() + "&& " + createDatasetCommand, ' '.join(args))
+        createDatasetFolder = self.getScriptLocation("create-dataset-folder")
 
+        Plugin.runDefmap(self, path.join(createDatasetFolder, "prep_dataset.py"), ' '.join(args),
+                         cwd=createDatasetFolder)
+
+    @measureStep
     def inferenceStep(self):
 
+        cache = self.getCache()
+        suffixes = self.getPredictionSuffixes()
+        if cache is not None and all(cache.get(self.getPredictionKey(suffix), self.getResult('prediction', suffix))
+                                     for suffix in suffixes):
+            logger.info("Prediction found in the cache")
+            return
+
+        if self.isStreamInference():
+            self.streamInference()
+        elif self.isEnsemble():
+            self.ensembleInference()
+        else:
+            self.singleInference()
+
+        if cache is not None:
+            for suffix in suffixes:
+                cache.put(self.getPredictionKey(suffix), self.getResult('prediction', suffix))
+
+    def singleInference(self):
+
         # Get path to trained model
 
         trainedModelLocation = self.getScriptLocation(str(self.inputResolution))
@@ -189,21 +410,160 @@ class DefMapNeuralNetwork(Protocol):
                 '-o "%s"' % trainedModelLocation
                 ]
         
-        if self.gpuList.get():
-            args.append('-g %s' % self.gpuList.get())
+        if self.getGpus():
+            args.append('-g %s' % self.getGpus())
 
         # execute inference
 
-        inferenceCommand = "python " + self.getScriptLocation("inference")
+        if self.useInferenceWorker and not self.isCpuInference():
+            self.runInferenceWorker(args)
+        else:
+            # the batch script sets the batch size of the models of 3dcnn_main.py
+            jobsFile = self.getResultsFolder() + "/inference_jobs.json"
+            with open(jobsFile, "w") as jobs:
+                json.dump([[self.getResult('dataset'), self.getResult('prediction'), trainedModelLocation]], jobs)
+            self.runBatchInference(jobsFile)
 
-        self._enterDir(self.getScriptLocation(""))
-        self.runJob(Plugin.getEnvActivationCommand() + "&& " + inferenceCommand, ' '.join(args))
+    def ensembleInference(self):
 
-    def postprocStepVoxel(self):
+        # The three models predict the same dataset in one session
+
+        jobsFile = self.getResultsFolder() + "/inference_jobs.json"
+        with open(jobsFile, "w") as jobs:
+            json.dump([[self.getResult('dataset'), self.getResult('prediction', suffix), self.getModels(suffix)[0]]
+                       for suffix in MODEL_SUFFIXES], jobs)
+
+        self.runBatchInference(jobsFile, average=self.getResult('prediction'))
+
+    def runBatchInference(self, jobsFile, average=None):
+
+        args = [
+                '--script "%s"' % self.getScriptLocation("inference"),
+                '--jobs "%s"' % jobsFile
+                ]
+
+        if average:
+            args.append('--average "%s"' % average)
+
+        args.append('--batch-size %d' % self.batchSize.get())
+
+        if self.getGpus():
+            args.append('-g %s' % self.getGpus())
+
+        Plugin.runDefmap(self, Plugin.getPluginScript('defmap_batch_infer.py'), ' '.join(args),
+                         cwd=self.getScriptLocation(""), **self.getCpuResources())
+
+    def streamInference(self):
+
+        # The sub-voxels go from the map (or the dataset) to the models in chunks
+
+        suffixes = MODEL_SUFFIXES if self.isEnsemble() else ['']
+
+        args = [
+                '--models %s' % ' '.join('"%s"' % self.getInferenceModel(suffix) for suffix in suffixes),
+                '--outputs %s' % ' '.join('"%s"' % self.getResult('prediction', suffix) for suffix in suffixes),
+                '--chunk-size %d' % self.chunkSize.get()
+                ]
+
+        processes = 1
+        if not self.streamDataset:
+            args.append('-d "%s"' % self.getResult('dataset'))
+        else:
+            args.append('-m "%s"' % self.getMap())
+            if self.getMask():
+                args.append('--mask "%s"' % self.getMask())
+            if self.tileSize.get():
+                processes = self.getTileProcesses()
+                args.append('--tile-size %d' % self.tileSize.get())
+                args.append('--processes %d' % processes)
+
+        if self.isEnsemble():
+            args.append('--average "%s"' % self.getResult('prediction'))
+
+        args.append('--batch-size %d' % self.batchSize.get())
+
+        if self.resumableInference:
+            args.append('--shards "%s"' % self.getResult('shards'))
+
+        if self.isOnnxRuntime():
+            args.append('--runtime onnx')
+            args.append('--threads %d' % self.getCpuResources(processes)['cpuThreads'])
+
+        if self.getGpus():
+            args.append('-g %s' % self.getGpus())
+
+        Plugin.runDefmap(self, Plugin.getPluginScript('defmap_stream_infer.py'), ' '.join(args),
+                         cwd=self.getScriptLocation(""), **self.getCpuResources(processes))
+
+    def runInferenceWorker(self, args):
+
+        gpus = self.getGpus()
+        socketPath = Plugin.getWorkerSocket(gpus)
+
+        if not isWorkerRunning(socketPath):
+            logger.info("Starting inference worker at %s" % socketPath)
+            models = [self.getScriptLocation(model) for model in ["0", "1", "2"]]
+            Plugin.startInferenceWorker(self.getScriptLocation("inference"), models, gpus)
+        if not waitForWorker(socketPath, WORKER_START_TIMEOUT):
+            raise Exception('The inference worker did not start, see %s.log' % socketPath)
+
+        request = {
+                'command': 'infer',
+                'args': shlex.split(' '.join(args)),
+                'cwd': self.getScriptLocation(""),
+                'batchSize': self.batchSize.get(),
+                'gpu': gpus
+                }
+        response = sendRequest(socketPath, request)
+        logger.info(response.get('output', ''))
+
+        if response['status'] != 'ok':
+            raise Exception('Inference worker failed:\n%s' % response['message'])
+
+    @measureStep
+    def exportModelsStep(self):
+
+        if not Plugin.hasOnnxPackages():
+            raise Exception('The DefMap environment has no ONNX packages. Set %s=True in the Scipion '
+                            'config and reinstall DefMap to use ONNX Runtime' % DEFMAP_INSTALL_ONNX)
+
+        cache = self.getCache()
+        quantization = ONNX_QUANTIZATIONS[self.onnxQuantization.get()]
+        for model in self.getModels():
+            onnxModel = self.getOnnxModel(model)
+            # exports of other runs are in the cache
+            if path.exists(onnxModel) or (cache is not None and cache.get(self.getOnnxKey(model), onnxModel)):
+                continue
+
+            makedirs(path.dirname(onnxModel), exist_ok=True)
+            args = [
+                    '--model "%s"' % model,
+                    '--output "%s"' % onnxModel,
+                    '--quantization %s' % quantization,
+                    '--check-map "%s"' % Plugin.getTestMap(),
+                    '--report "%s"' % (onnxModel + '.json')
+                    ]
+            Plugin.runDefmap(self, Plugin.getPluginScript('defmap_onnx.py'), ' '.join(args),
+                             cwd=self.getScriptLocation(""), **self.getCpuResources())
+
+            if cache is not None:
+                cache.put(self.getOnnxKey(model), onnxModel)
+
+    @measureStep
+    def postprocStepVoxel(self, suffix=''):
+
+        if self.isStreamInference():
+            # compact binary copy of the voxels, quicker to load than the PDB
+            predictionToNpz(self.getResult('prediction', suffix), self.getMap(), self.getResult('output-npz', suffix))
+
+        if self.voxelWriter.get() == VOXELS_NUMPY:
+            predictionToGridPdb(self.getResult('prediction', suffix), self.getMap(),
+                                self.getResult('output-voxel', suffix))
+            return
 
         # Set arguments to Postprocessing command
         args = [
-                '-p "%s"' % self.getResult('prediction'),
+                '-p "%s"' % self.getResult('prediction', suffix),
                 '-t 0.0'
                 ]
         
@@ -216,83 +576,110 @@ class DefMapNeuralNetwork(Protocol):
             args.append('-m "%s" ' % self.getResult('volumes'))
             name = "volumes.pdb"
 
-        command = "python " + self.getScriptLocation("postprocessing-voxel")
+        # call command in a folder of its own, the result is written in the current directory
 
-        # call command
-
-        self._enterDir(self.getScriptLocation("postprocessing-folder"))
-        self.runJob(Plugin.getEnvActivationCommand() + "&& " + command, ' '.join(args))
+        folder = self.createStepFolder('voxel' + suffix)
+        Plugin.runDefmap(self, self.getScriptLocation("postprocessing-voxel"), ' '.join(args), cwd=folder)
 
         # move result to working directory
 
-        rename(name, self.getResult('output-voxel'))
+        rename(path.join(folder, name), self.getResult('output-voxel', suffix))
+        rmtree(folder)
+
 
+    @measureStep
+    def postprocStepPdb(self, suffix=''):
 
-    def postprocStepPdb(self):
+        if self.inputStructure.hasValue() and self.atomMapping.get() != MAPPING_SCRIPT:
+            predictionToModel(self.getResult('prediction', suffix), self.getMap(),
+                              self.getResult('atomic-structure'), self.getResult('output-pdb', suffix),
+                              method=self.atomMapping.get(), radius=self.mappingRadius.get(),
+                              workers=self.numberOfThreads.get())
 
-        if(self.inputStructure.hasValue()):
+        elif self.inputStructure.hasValue():
 
             # Prepare the file that points to the Atomic Structure and the Volumes
 
-            pointerFileLocation = self.resultsFolder + "/sample_for_visual.list"
+            pointerFileLocation = self.getResult('pointer', suffix)
 
             if self.inputPreprocess:
                 with open(pointerFileLocation,"w") as pointerFile:
-                    pointerFile.write("structure.pdb output_volumeT.mrc")
+                    pointerFile.write("%s %s" % (self.getResult('atomic-structure'), self.getResult('preprocessOutput')))
             else:
                 with open(pointerFileLocation,"w") as pointerFile:
-                    pointerFile.write("structure.pdb volumes.mrc")
+                    pointerFile.write("%s %s" % (self.getResult('atomic-structure'), self.getResult('volumes')))
 
             # Set arguments to Postprocessing command
             args = [
                     '-l "%s"' % pointerFileLocation,
-                    '-p "%s"' % self.getResult('prediction'),
+                    '-p "%s"' % self.getResult('prediction', suffix),
                     '-n'
                     ]
 
-            command = "python " + self.getScriptLocation("postprocessing-pdb")
+            # call command in a folder of its own, the result is written in the current directory
 
-            # call command
-
-            self._enterDir(self.getScriptLocation("postprocessing-folder"))
-            self.runJob(Plugin.getEnvActivationCommand() + "&& " + command, ' '.join(args))
+            folder = self.createStepFolder('pdb' + suffix)
+            Plugin.runDefmap(self, self.getScriptLocation("postprocessing-pdb"), ' '.join(args), cwd=folder)
 
             # move result to working directory
 
-            rename(path.abspath('defmap_norm_model.pdb'), self.getResult('output-pdb'))
+            rename(path.join(folder, 'defmap_norm_model.pdb'), self.getResult('output-pdb', suffix))
+            rmtree(folder)
         
         else:
             logger.info("No Atomic Structure detected - only visualization by voxels")
 
         
     
+    @measureStep
     def createOutputStep(self):
 
-        voxelFileName = self.getResult("output-voxel")
-        pdbFileName = self.getResult("output-pdb")
         extraVolumes = self.getResult("preprocessOutput")
 
-        if path.exists(voxelFileName):
-            logger.info('Setting voxel file')
-            outputPdbVoxel = AtomStruct(filename=voxelFileName)
-            self._defineOutputs(outputStructureVoxel=outputPdbVoxel)
-
-        if path.exists(pdbFileName):
-            logger.info('Setting pdb file')
-            outputPdb = AtomStruct(filename=pdbFileName)
-            self._defineOutputs(outputStructure=outputPdb)
+        for suffix in self.getPredictionSuffixes():
+            voxelFileName = self.getResult("output-voxel", suffix)
+            pdbFileName = self.getResult("output-pdb", suffix)
+            npzFileName = self.getResult("output-npz", suffix)
+            flexibilityFileName = self.getResult("output-flexibility", suffix)
+
+            if self.isStreamInference():
+                # predicted log(RMSF) on the grid of the map given to the network
+                samplingRate = self.getMapSamplingRate()
+                predictionToMrc(self.getResult('prediction', suffix), self.getMap(), flexibilityFileName,
+                                samplingRate=samplingRate)
+                outputFlexibility = Volume(location=flexibilityFileName)
+                outputFlexibility.setSamplingRate(samplingRate)
+                if not self.inputPreprocess:
+                    # same grid as the input volume, the preprocessed one is left at the default origin
+                    outputFlexibility.setOrigin(self.inputVolume.get().getOrigin(force=True).clone())
+                self._defineOutputs(**{'outputFlexibility' + suffix.strip('_'): outputFlexibility})
+                self._defineSourceRelation(self.inputVolume, outputFlexibility)
+
+            if path.exists(npzFileName):
+                logger.info('Setting voxel predictions file')
+                outputPredictions = EMFile(filename=npzFileName)
+                self._defineOutputs(**{'outputPredictions' + suffix.strip('_'): outputPredictions})
+
+            if path.exists(voxelFileName):
+                logger.info('Setting voxel file')
+                outputPdbVoxel = AtomStruct(filename=voxelFileName)
+                self._defineOutputs(**{'outputStructureVoxel' + suffix.strip('_'): outputPdbVoxel})
+
+            if path.exists(pdbFileName):
+                logger.info('Setting pdb file')
+                outputPdb = AtomStruct(filename=pdbFileName)
+                self._defineOutputs(**{'outputStructure' + suffix.strip('_'): outputPdb})
 
         if path.exists(extraVolumes): 
             logger.info('Setting volume')
             outputVolume = Volume(location=extraVolumes)
-            x, y, z, n = ImageHandler.getDimensions(extraVolumes)
-            
+            dimensions = MrcVolume(extraVolumes).getDimensions()
 
             pdbReference = AtomicStructHandler(self.getResult('atomic-structure'))
             x_ref,y_ref,z_ref = pdbReference.centerOfMass(True)
 
             logger.info("volume")
-            logger.info(ImageHandler.getDimensions(extraVolumes))
+            logger.info(dimensions)
             logger.info(outputVolume.getOrigin())
             logger.info("atomic structure")
             logger.info(pdbReference.centerOfMass(True))
@@ -306,7 +693,7 @@ class DefMapNeuralNetwork(Protocol):
     def createPymolFile(self):
 
         # create file with pymol commands:
-        pointerFileLocation = self.resultsFolder + "/pointer_for_pymol.pml"
+        pointerFileLocation = self.getResultsFolder() + "/pointer_for_pymol.pml"
 
         with open(pointerFileLocation,"w") as pointerFile:
             pointerFile.write("load defmap_norm_model.pdb"+"\n"
@@ -322,36 +709,16 @@ class DefMapNeuralNetwork(Protocol):
     # --------------------------- UTILS functions -----------------------------------
 
     def getScriptLocation(self,step=None):
-
-        commonPath = Config.SCIPION_HOME + "/software/em/"+ DEFAULT_SCRIPT_FOLDER
-        specificPath = ""
-
-        if step == "create-dataset-folder":
-            specificPath = "/preprocessing"
-
-        elif step == "inference" :
-            specificPath = "/3dcnn_main.py"
-
-        elif step == "0":
-            specificPath="/model/model_res5A.h5"
-
-        elif step == "1":
-            specificPath="/model/model_res6A.h5"
-
-        elif step == "2":
-            specificPath="/model/model_res7A.h5"
-
-        elif step == "postprocessing-pdb":
-            specificPath = "/postprocessing/rmsf_map2model_for_defmap.py"
-        
-        elif step == "postprocessing-voxel":
-            specificPath = "/postprocessing/rmsf_map2grid.py"
-
-        elif step == "postprocessing-folder":
-            specificPath="/postprocessing"
-
-        return commonPath + specificPath
+        return Plugin.getScriptLocation(step)
     
+    def createStepFolder(self, name):
+        """ Empty folder to run a DefMap script that writes in the current directory. """
+        folder = path.join(self.getResultsFolder(), 'tmp_' + name)
+        if path.exists(folder):
+            rmtree(folder)
+        makedirs(folder)
+        return folder
+
     def obtainLink(self,location, destination):
         if path.islink(location):
             source = readlink(location)
@@ -360,7 +727,11 @@ class DefMapNeuralNetwork(Protocol):
             symlink(location, destination)
 
 
-    def getResult(self, name):
+    def getResultsFolder(self):
+        """ Folder of the results, from the protocol itself, so it is known in a continued run. """
+        return path.abspath(self._getExtraPath())
+
+    def getResult(self, name, suffix=''):
         if name == 'volumes':
             file = '/volumes.mrc'
         elif name == 'dataset':
@@ -371,8 +742,16 @@ class DefMapNeuralNetwork(Protocol):
             file = '/structure.pdb'
         elif name == 'output-voxel':
             file = '/voxel-visualization.pdb'
+        elif name == 'output-flexibility':
+            file = '/flexibility.mrc'
+        elif name == 'output-npz':
+            file = '/voxel-predictions.npz'
         elif name == 'output-pdb':
             file = '/defmap_norm_model.pdb'
+        elif name == 'pointer':
+            file = '/sample_for_visual.list'
+        elif name == 'shards':
+            file = '/inference_shards'
         elif name == 'preprocessCrop':
             file = '/output_volumeC.mrc'
         elif name == 'preprocessFilter':
@@ -383,11 +762,14 @@ class DefMapNeuralNetwork(Protocol):
             file = '/output_volumeA.mrc'
         elif name == 'preprocessOutput':
             file = '/output_volumeT.mrc'
-        elif name == 'transformedMask':
-            file = '/mask.vol'
         else:
             file = ''
-        return  self.resultsFolder + file
+
+        if suffix:
+            file = suffix.join(path.splitext(file))
+        if name == 'output-voxel' and self.compressVoxels and self.voxelWriter.get() == VOXELS_NUMPY:
+            file += '.gz'
+        return  self.getResultsFolder() + file
     
     def checkExtension(self,file,extension):
         file_extension = path.splitext(file)[1]
@@ -402,12 +784,16 @@ class DefMapNeuralNetwork(Protocol):
                 self.volumesLocation = path.abspath(file)
             return True
         elif file_extension == '.cif' and extension == '.pdb':
-            file_renamed = path.join(self.resultsFolder, path.splitext(path.split(file)[1])[0] + ".pdb")
+            file_renamed = path.join(self.getResultsFolder(), path.splitext(path.split(file)[1])[0] + ".pdb")
             cifToPdb(file,file_renamed)
             self.structureLocation = path.abspath(file_renamed)
             return True
+        elif extension == '.mrc' and isMrcFile(file):
+            # .map, .ccp4... are mrc files with another extension
+            self.volumesLocation = path.abspath(file)
+            return True
         elif extension == '.mrc':
-            file_renamed = path.join(self.resultsFolder, path.splitext(path.split(file)[1])[0] + ".mrc")
+            file_renamed = path.join(self.getResultsFolder(), path.splitext(path.split(file)[1])[0] + ".mrc")
             imgh = ImageHandler()
             imgh.convert(file,file_renamed)
             self.volumesLocation = path.abspath(file_renamed)
@@ -415,9 +801,136 @@ class DefMapNeuralNetwork(Protocol):
         else:
             return False
         
+    def getThreshold(self):
+        if self.inputThreshold.hasValue():
+            return self.inputThreshold.get()
+        return 0.0
+
+    def getCache(self):
+        if self.useCache:
+            return Plugin.getCache()
+        return None
+
+    def getMap(self):
+        """ Map given to the neural network: the preprocessed one or the input. """
+        if self.inputPreprocess:
+            return self.getResult('preprocessOutput')
+        return self.getResult('volumes')
+
+    def getMapSamplingRate(self):
+        """ Sampling rate (Å/px) in Scipion of the map given to the network. """
+        if self.inputPreprocess:
+            return PREPROCESS_SAMPLING
+        return float(self.inputVolume.get().getSamplingRate())
+
+    def getMask(self):
+        """ Protein mask of the preprocessing, the sub-voxels of the solvent are not predicted.
+        Without preprocessing, only the intensity threshold of the sub-voxels is used. """
+        if self.inputPreprocess:
+            return self.getResult('preprocessMask')
+        return None
+
+    def getVolumeHash(self):
+        """ Hash of the contents of the input volume, computed once per run. """
+        if not hasattr(self, 'volumeHash'):
+            self.volumeHash = hashFile(self.getResult('volumes')).hexdigest()
+        return self.volumeHash
+
+    def getCropKey(self):
+        """ Cache key of the cropped volume of Xmipp: the input volume and its sampling rate. """
+        return hashKey('xmipp-crop', self.getVolumeHash(), float(self.inputVolume.get().getSamplingRate()))
+
+    def getFilterKey(self, factor):
+        """ Cache key of the filtered volume of Xmipp: the cropped volume and the filter. """
+        return hashKey('xmipp-filter', self.getCropKey(), factor)
+
+    def getDatasetKey(self):
+        """ Cache key of the dataset: the input volume, its sampling rate and the preprocessing parameters. """
+        parameters = [self.getVolumeHash(), float(self.inputVolume.get().getSamplingRate()),
+                      bool(self.inputPreprocess), self.datasetBuilder.get()]
+        if self.inputPreprocess:
+            parameters += [self.preprocessEngine.get(), self.getThreshold(),
+                           self.getResolution(self.inputResolution.get())]
+        return hashKey('dataset', *parameters)
+
+    def getPredictionKey(self, suffix=''):
+        """ Cache key of the prediction: the dataset and the trained models. """
+        models = [hashFile(model).hexdigest() for model in self.getModels(suffix)]
+        if self.isOnnxRuntime():
+            models.append('onnx-' + ONNX_QUANTIZATIONS[self.onnxQuantization.get()])
+        if self.streamDataset:
+            return hashKey('stream-prediction', self.getDatasetKey(), *models)
+        return hashKey('prediction', self.getDatasetKey(), *models)
+
+    def isStreamInference(self):
+        """ Whether the prediction is made by defmap_stream_infer.py, in the layout
+        of savePrediction. Only those predictions give the voxel predictions
+        file and the flexibility volume. """
+        return self.streamDataset or self.isOnnxRuntime() or self.resumableInference
+
+    def isCpuInference(self):
+        return self.inferenceDevice.get() == INFERENCE_CPU
+
+    def getGpus(self):
+        """ GPUs given to the inference, none on the CPU. """
+        if self.isCpuInference():
+            return ''
+        return self.gpuList.get()
+
+    def getTileProcesses(self):
+        """ Processes predicting tiles: one per thread on the CPU. A single one
+        on the GPU, as every process would load the models in the same GPUs. """
+        if not self.isCpuInference():
+            return 1
+        return max(1, self.numberOfThreads.get())
+
+    def getCpuResources(self, processes=1):
+        """ Threads of each inference process and cores to pin them to, on the CPU. """
+        if not self.isCpuInference():
+            return {}
+        return {'cpuThreads': max(1, self.numberOfThreads.get() // processes),
+                'cpuList': self.cpuList.get() or ''}
+
+    def isOnnxRuntime(self):
+        return self.isCpuInference() and self.inferenceRuntime.get() == RUNTIME_ONNX
+
+    def getInferenceModel(self, suffix=''):
+        """ Model run for the prediction of a single model: the Keras one or its ONNX export. """
+        model = self.getModels(suffix)[0]
+        if self.isOnnxRuntime():
+            return self.getOnnxModel(model)
+        return model
+
+    def getOnnxModel(self, model):
+        """ ONNX export of a Keras model with the quantization of the form, in the extra folder. """
+        name = path.splitext(path.basename(model))[0]
+        quantization = ONNX_QUANTIZATIONS[self.onnxQuantization.get()]
+        return path.abspath(self._getExtraPath('onnx', '%s_%s.onnx' % (name, quantization)))
+
+    def getOnnxKey(self, model):
+        """ Cache key of an ONNX export: the Keras model and the quantization. """
+        return hashKey('onnx', hashFile(model).hexdigest(), ONNX_QUANTIZATIONS[self.onnxQuantization.get()])
+
+    def isEnsemble(self):
+        return self.inputResolution.get() == RESOLUTION_ALL
+
+    def getPredictionSuffixes(self):
+        """ Suffixes of the predictions: the main one and, with all the models, one for each model. """
+        if self.isEnsemble():
+            return [''] + MODEL_SUFFIXES
+        return ['']
+
+    def getModels(self, suffix=''):
+        """ Trained models behind the prediction with the given suffix. """
+        if suffix:
+            return [self.getScriptLocation(str(MODEL_SUFFIXES.index(suffix)))]
+        elif self.isEnsemble():
+            return [self.getScriptLocation(str(option)) for option in range(len(MODEL_SUFFIXES))]
+        return [self.getScriptLocation(str(self.inputResolution.get()))]
+
     def getResolution(self, option):
         logger.info(type(option))
-        if option == 0:
+        if option == 0 or option == RESOLUTION_ALL:
             return 5.0
         elif option == 1:
             return 6.0
@@ -425,14 +938,30 @@ class DefMapNeuralNetwork(Protocol):
             return 7.0
         
     # --------------------------- PREPROCESS functions ----------------------------------- 
+
+    def preprocessInProcess(self):
+
+        cache = self.getCache()
+        preprocessVolume(self.getResult('volumes'), self.getResult('preprocessOutput'),
+                         samplingRate=float(self.inputVolume.get().getSamplingRate()),
+                         resolution=self.getResolution(self.inputResolution.get()),
+                         threshold=self.getThreshold(),
+                         cache=cache, volumeKey=self.getVolumeHash() if cache is not None else None,
+                         maskFile=self.getResult('preprocessMask'))
         
     def cropResizeVolumes(self):
 
         samplingRate = float(self.inputVolume.get().getSamplingRate())
 
+        # it does not depend on the resolution or the threshold, so it can come from another run
+        cache = self.getCache()
+        if cache is not None and cache.get(self.getCropKey(), self.getResult('preprocessCrop')):
+            logger.info("Cropped volume found in the cache")
+            return
+
         factorTransform = samplingRate / 3
 
-        self.transformFilter(self.volumesLocation,self.getResult('preprocessCrop'),factorTransform,None)
+        self.transformFilter(self.getResult('volumes'),self.getResult('preprocessCrop'),factorTransform,None)
 
         factorResize = samplingRate / 1.5
 
@@ -445,13 +974,24 @@ class DefMapNeuralNetwork(Protocol):
 
         self.imageHeader(self.getResult('preprocessCrop'))
 
+        if cache is not None:
+            cache.put(self.getCropKey(), self.getResult('preprocessCrop'))
+
     def filterVolumes(self):
         factor1 = 1.5 / self.getResolution(self.inputResolution)
         factor2 = 1.5 / 100
 
+        cache = self.getCache()
+        if cache is not None and cache.get(self.getFilterKey(factor1), self.getResult('preprocessFilter')):
+            logger.info("Filtered volume found in the cache")
+            return
+
         self.transformFilter(self.getResult('preprocessCrop'),self.getResult('preprocessFilter'),factor1,factor2)
         self.imageHeader(self.getResult('preprocessFilter'))
 
+        if cache is not None:
+            cache.put(self.getFilterKey(factor1), self.getResult('preprocessFilter'))
+
     def create3dMask(self):
 
         threshold = 0.0
@@ -470,19 +1010,8 @@ class DefMapNeuralNetwork(Protocol):
 
     def apply3dMask(self):
 
-        self.transformMask()
-        args = [
-                '-i "%s"' % self.getResult('preprocessFilter'),
-                '--mult "%s"' % self.getResult('transformedMask'),
-                '-o "%s"' % self.getResult('preprocessApplyMask')
-                ]
-        
-        xmipp3Plugin.runXmippProgram('xmipp_image_operate',' '.join(args))
-
-        self.imageHeader(self.getResult('preprocessApplyMask'))
-
-    def transformMask(self):
-        ImageHandler().convert(self.getResult('preprocessMask'), self.getResult('transformedMask'))
+        multiplyMrc(self.getResult('preprocessFilter'), self.getResult('preprocessMask'),
+                    self.getResult('preprocessApplyMask'), PREPROCESS_SAMPLING)
 
     def volumesThreshold(self):
 
@@ -506,12 +1035,7 @@ class DefMapNeuralNetwork(Protocol):
         xmipp3Plugin.runXmippProgram('xmipp_transform_filter',' '.join(args))
 
     def imageHeader(self, input):
-        args = [
-                '-i "%s"' % input,
-                '--sampling_rate %f' % 1.5
-                ]
-        
-        xmipp3Plugin.runXmippProgram('xmipp_image_header',' '.join(args))
+        setMrcSamplingRate(input, PREPROCESS_SAMPLING)
 
     def transformThreshold(self, input, output, substitute, threshold):
         args = [
@@ -538,12 +1062,39 @@ class DefMapNeuralNetwork(Protocol):
 
 
     # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = []
+
+        if self.inputPreprocess and self.preprocessEngine.get() == PREPROCESS_XMIPP and not haveXmipp:
+            errors.append("Xmipp is not installed. Use the NumPy preprocessing engine "
+                          "or install scipion-em-xmipp.")
+
+        if self.isCpuInference() and self.cpuList.get():
+            try:
+                cores = parseCpuList(self.cpuList.get())
+            except ValueError:
+                cores = None
+            if not cores:
+                errors.append("The CPU cores must be a list like 0-7,16-23.")
+            elif len(cores) < self.numberOfThreads.get():
+                errors.append("There are fewer CPU cores (%d) than threads (%d)."
+                              % (len(cores), self.numberOfThreads.get()))
+
+        if self.batchSize.get() < 0:
+            errors.append("The batch size cannot be negative.")
+        return errors
+
     def _summary(self):
         summary = []
 
         if self.isFinished():
             sum1 = "This protocol has run DefMap Neural Network branch tf29, created by Shigeyuki Matsumoto and Shoichi Ishida."
             summary.append(sum1)
+
+        measures = readMeasures(self._getExtraPath(PERF_FILE))
+        if measures:
+            summary.append("Resources used by the steps (details in extra/%s):" % PERF_FILE)
+            summary += summarizeMeasures(measures)
         return summary
     
     def _methods(self):
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Protocol to run DefMap neural network over a set of volumes
+"""
+
+import json
+from os import path, makedirs, remove, rename, symlink
+from shutil import rmtree
+
+from pyworkflow.protocol import Protocol, params, constants
+from pyworkflow.utils import Message, logger
+from defmap import Plugin
+from defmap.constants import *
+from defmap.convert import isMrcFile
+from defmap.preprocessing import preprocessVolume
+from pwem.objects import AtomStruct, SetOfAtomStructs
+from pwem.convert.atom_struct import cifToPdb
+
+
+class DefMapNeuralNetworkBatch(Protocol):
+
+    @classmethod
+    def getClassPackageName(cls):
+        return "defmap"
+
+    def __init__(self, **kwargs):
+        Protocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = constants.STEPS_PARALLEL
+
+    _label = 'Defmap batch prediction'
+    _possibleOutputs = {'outputStructures': SetOfAtomStructs, 'outputStructuresVoxel': SetOfAtomStructs}
+
+    # -------------------------- INPUT PARAMETERS ----------------------
+    def _defineParams(self, form):
+        """ 
+        Params:
+            * form: this is the form to be populated with sections and params.
+            * inputVolumes: set of volumes to predict.
+            * inputStructures: atomic structures matching the volumes, in the same order.
+            * resolution: resolution model for the inference step. Options: 5A, 6A o 7A.
+            * threshold: top threshold to drop sub-voxels with a standardized intensity.
+        """
+
+        form.addSection(label=Message.LABEL_INPUT)
+
+        form.addHidden(params.GPU_LIST, params.StringParam,
+                       expertLevel=constants.LEVEL_ADVANCED,
+                       label='Constrain GPU',
+                       default='1',
+                       help="Constrain GPU usage at inference step")
+
+        form.addParam('inputVolumes', params.PointerParam,
+                      label='Volumes', important=True,
+                      help='Set of 3D reconstructions, e.g. a conformational ensemble. They must be scaled.',
+                      pointerClass="SetOfVolumes")
+
+        form.addParam('inputStructures', params.MultiPointerParam,
+                      label='Atomic structures', allowsNull=True,
+                      help='Atomic structures of the molecules, one for each volume and in the same order.',
+                      pointerClass="AtomStruct")
+
+        form.addParam('inputResolution', params.EnumParam,
+                      label='Resolution',
+                      help='Resolution model for the inference step. There are three models according to three possible resolutions.',
+                      default=0, choices=["5 Å","6 Å","7 Å"])
+
+        form.addParam('inputPreprocess', params.BooleanParam, default=False,
+                      label='Whether to preprocess the volumes',
+                      help="In case you want to preprocess, it will change the sampling rate to 1.5 A and the resolution "
+                           "to the one selected. The volumes are preprocessed in memory with NumPy.")
+
+        form.addParam('inputThreshold', params.FloatParam,
+                        allowsNull=True, important = False,
+                        condition='inputPreprocess == True',
+                        label='Threshold',
+                        help='Top threshold to drop voxels with a standardized intensity.\n'
+                              'If not given, a threshold of 0 will be used for preprocessing.')
+
+        form.addParallelSection(threads=1, mpi=0)
+
+    # --------------------------- STEPS ------------------------------
+    def _insertAllSteps(self):
+        volumeIds = [volume.getObjId() for volume in self.inputVolumes.get()]
+
+        convertSteps = []
+        for volumeId in volumeIds:
+            stepId = self._insertFunctionStep('convertInputStep', volumeId, prerequisites=[])
+            if self.inputPreprocess:
+                stepId = self._insertFunctionStep('preprocessStep', volumeId, prerequisites=[stepId])
+            convertSteps.append(self._insertFunctionStep('createDatasetStep', volumeId, prerequisites=[stepId]))
+
+        inferenceStep = self._insertFunctionStep('inferenceStep', volumeIds, prerequisites=convertSteps)
+
+        postprocSteps = []
+        for volumeId in volumeIds:
+            postprocSteps.append(self._insertFunctionStep('postprocStepVoxel', volumeId, prerequisites=[inferenceStep]))
+            postprocSteps.append(self._insertFunctionStep('postprocStepPdb', volumeId, prerequisites=[inferenceStep]))
+
+        self._insertFunctionStep('createOutputStep', volumeIds, prerequisites=postprocSteps)
+
+    def convertInputStep(self, volumeId):
+        folder = self.getVolumeFolder(volumeId)
+        makedirs(folder, exist_ok=True)
+
+        volumeFile = path.abspath(self.inputVolumes.get()[volumeId].getFileName())
+        if not isMrcFile(volumeFile):
+            raise Exception('The format of the volume %s is not supported' % volumeFile)
+        self.linkFile(volumeFile, self.getResult(volumeId, 'volumes'))
+
+        structure = self.getStructure(volumeId)
+        if structure is not None:
+            structureFile = path.abspath(structure.getFileName())
+            if structureFile.endswith('.cif'):
+                cifToPdb(structureFile, self.getResult(volumeId, 'atomic-structure'))
+            elif structureFile.endswith('.pdb'):
+                self.linkFile(structureFile, self.getResult(volumeId, 'atomic-structure'))
+            else:
+                raise Exception('The extension of the atomic structure is not suported')
+
+    def preprocessStep(self, volumeId):
+
+        threshold = 0.0
+        if self.inputThreshold.hasValue():
+            threshold = self.inputThreshold.get()
+
+        preprocessVolume(self.getResult(volumeId, 'volumes'), self.getResult(volumeId, 'preprocessOutput'),
+                         samplingRate=float(self.inputVolumes.get()[volumeId].getSamplingRate()),
+                         resolution=self.getResolution(),
+                         threshold=threshold)
+
+    def createDatasetStep(self, volumeId):
+
+        args = [
+                '-o "%s"' % self.getResult(volumeId, 'dataset'),
+                '-p',
+                '-m "%s"' % self.getMap(volumeId)
+                ]
+
+        createDatasetFolder = Plugin.getScriptLocation("create-dataset-folder")
+        Plugin.runDefmap(self, path.join(createDatasetFolder, "prep_dataset.py"), ' '.join(args),
+                         cwd=createDatasetFolder)
+
+    def inferenceStep(self, volumeIds):
+
+        # All the datasets go through the same model session
+
+        jobsFile = self._getExtraPath('inference_jobs.json')
+        with open(jobsFile, 'w') as jobs:
+            json.dump([[self.getResult(volumeId, 'dataset'), self.getResult(volumeId, 'prediction')]
+                       for volumeId in volumeIds], jobs)
+
+        args = [
+                '--script "%s"' % Plugin.getScriptLocation("inference"),
+                '--model "%s"' % Plugin.getScriptLocation(str(self.inputResolution.get())),
+                '--jobs "%s"' % path.abspath(jobsFile)
+                ]
+
+        if self.gpuList.get():
+            args.append('-g %s' % self.gpuList.get())
+
+        Plugin.runDefmap(self, Plugin.getPluginScript('defmap_batch_infer.py'), ' '.join(args),
+                         cwd=Plugin.getScriptLocation(""))
+
+    def postprocStepVoxel(self, volumeId):
+
+        args = [
+                '-p "%s"' % self.getResult(volumeId, 'prediction'),
+                '-t 0.0',
+                '-m "%s"' % self.getMap(volumeId)
+                ]
+
+        folder = self.createStepFolder(volumeId, 'voxel')
+        Plugin.runDefmap(self, Plugin.getScriptLocation("postprocessing-voxel"), ' '.join(args), cwd=folder)
+
+        name = path.splitext(path.basename(self.getMap(volumeId)))[0] + ".pdb"
+        rename(path.join(folder, name), self.getResult(volumeId, 'output-voxel'))
+        rmtree(folder)
+
+    def postprocStepPdb(self, volumeId):
+
+        if self.getStructure(volumeId) is None:
+            logger.info("No Atomic Structure for volume %d - only visualization by voxels" % volumeId)
+            return
+
+        pointerFileLocation = self.getResult(volumeId, 'pointer')
+        with open(pointerFileLocation, "w") as pointerFile:
+            pointerFile.write("%s %s" % (self.getResult(volumeId, 'atomic-structure'), self.getMap(volumeId)))
+
+        args = [
+                '-l "%s"' % pointerFileLocation,
+                '-p "%s"' % self.getResult(volumeId, 'prediction'),
+                '-n'
+                ]
+
+        folder = self.createStepFolder(volumeId, 'pdb')
+        Plugin.runDefmap(self, Plugin.getScriptLocation("postprocessing-pdb"), ' '.join(args), cwd=folder)
+
+        rename(path.join(folder, 'defmap_norm_model.pdb'), self.getResult(volumeId, 'output-pdb'))
+        rmtree(folder)
+
+    def createOutputStep(self, volumeIds):
+
+        outputVoxel = SetOfAtomStructs(filename=self._getPath('atomStructsVoxel.sqlite'))
+        outputPdb = SetOfAtomStructs(filename=self._getPath('atomStructs.sqlite'))
+
+        for volumeId in volumeIds:
+            volume = self.inputVolumes.get()[volumeId].clone()
+
+            voxelFileName = self.getResult(volumeId, 'output-voxel')
+            if path.exists(voxelFileName):
+                outputPdbVoxel = AtomStruct(filename=voxelFileName)
+                outputPdbVoxel.setVolume(volume)
+                outputVoxel.append(outputPdbVoxel)
+
+            pdbFileName = self.getResult(volumeId, 'output-pdb')
+            if path.exists(pdbFileName):
+                outputStructure = AtomStruct(filename=pdbFileName)
+                outputStructure.setVolume(volume)
+                outputPdb.append(outputStructure)
+
+        self._defineOutputs(outputStructuresVoxel=outputVoxel)
+        self._defineSourceRelation(self.inputVolumes, outputVoxel)
+
+        if outputPdb.getSize():
+            self._defineOutputs(outputStructures=outputPdb)
+            self._defineSourceRelation(self.inputVolumes, outputPdb)
+
+    # --------------------------- UTILS functions -----------------------------------
+
+    def getStructure(self, volumeId):
+        """ Atomic structure matching the volume, by position in the set. """
+        if not self.inputStructures:
+            return None
+        volumeIds = [volume.getObjId() for volume in self.inputVolumes.get()]
+        return self.inputStructures[volumeIds.index(volumeId)].get()
+
+    def getVolumeFolder(self, volumeId):
+        return path.abspath(self._getExtraPath('volume_%03d' % volumeId))
+
+    def linkFile(self, source, link):
+        """ Link to an input file, replacing the one of a previous run. """
+        if path.lexists(link):
+            remove(link)
+        symlink(source, link)
+
+    def createStepFolder(self, volumeId, name):
+        """ Empty folder to run a DefMap script that writes in the current directory. """
+        folder = path.join(self.getVolumeFolder(volumeId), 'tmp_' + name)
+        if path.exists(folder):
+            rmtree(folder)
+        makedirs(folder)
+        return folder
+
+    def getMap(self, volumeId):
+        if self.inputPreprocess:
+            return self.getResult(volumeId, 'preprocessOutput')
+        return self.getResult(volumeId, 'volumes')
+
+    def getResolution(self):
+        return [5.0, 6.0, 7.0][self.inputResolution.get()]
+
+    def getResult(self, volumeId, name):
+        files = {
+            'volumes': 'volumes.mrc',
+            'dataset': 'sample.jbl',
+            'prediction': 'prediction.jbl',
+            'atomic-structure': 'structure.pdb',
+            'output-voxel': 'voxel-visualization.pdb',
+            'output-pdb': 'defmap_norm_model.pdb',
+            'preprocessOutput': 'output_volumeT.mrc',
+            'pointer': 'sample_for_visual.list'
+        }
+        return path.join(self.getVolumeFolder(volumeId), files[name])
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = []
+
+        if self.inputStructures and len(self.inputStructures) != self.inputVolumes.get().getSize():
+            errors.append("There must be one atomic structure for each volume.")
+        return errors
+
+    def _summary(self):
+        summary = []
+
+        if self.isFinished():
+            summary.append("This protocol has run DefMap Neural Network branch tf29, created by "
+                           "Shigeyuki Matsumoto and Shoichi Ishida, over %d volumes."
+                           % self.inputVolumes.get().getSize())
+        return summary
+
+    def _methods(self):
+        methods = []
+
+        if self.isFinished():
+            methods.append("1. Create a dataset to test for each volume")
+            methods.append("2. Dynamics prediction of all the datasets with one model session")
+            methods.append("3. Postprocessing")
+        return methods
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# Scripts run inside the DefMap conda environment. They must only depend on
+# the standard library and the packages installed in that environment.
+# **************************************************************************
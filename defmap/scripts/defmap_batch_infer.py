@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Run "3dcnn_main.py infer" over several datasets and models in a single
+process, so TensorFlow is imported and every model is loaded only once.
+Optionally, the predictions are averaged into a new prediction file.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import joblib
+import numpy as np
+
+import defmap_worker
+from defmap_batching import getAvailableMemory
+from defmap_worker import patchModelLoading, patchPredict, runScript
+
+
+def averagePredictions(predictions):
+    """ Average the float arrays of several predictions with the same layout;
+    everything else (coordinates, indexes...) is taken from the first one. """
+    first = predictions[0]
+
+    if isinstance(first, dict):
+        return {key: averagePredictions([prediction[key] for prediction in predictions])
+                for key in first}
+    elif isinstance(first, (list, tuple)):
+        return type(first)(averagePredictions(list(items)) for items in zip(*predictions))
+
+    values = np.asarray(first)
+    if values.dtype.kind == 'f':
+        return np.mean([np.asarray(prediction) for prediction in predictions], axis=0).astype(values.dtype)
+    return first
+
+
+def getParser():
+    parser = argparse.ArgumentParser(description="DefMap batch inference")
+    parser.add_argument("--script", required=True, help="path to 3dcnn_main.py")
+    parser.add_argument("--model", default=None, help="trained model of the jobs that do not give one")
+    parser.add_argument("--jobs", required=True,
+                        help="json file with a list of [dataset, prediction] or [dataset, prediction, model]")
+    parser.add_argument("--average", default=None,
+                        help="file to write the average of all the predictions")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="batch size of the models, 0 to choose it from the available memory")
+    parser.add_argument("-g", "--gpu", default=None, help="GPUs to use")
+    return parser
+
+
+if __name__ == "__main__":
+    arguments = getParser().parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(arguments.script)))
+    cwd = os.getcwd()
+
+    with open(arguments.jobs) as jobsFile:
+        jobs = json.load(jobsFile)
+
+    jobs = [job if len(job) == 3 else job + [arguments.model] for job in jobs]
+    if arguments.gpu:
+        # the models are loaded before the first job sets it
+        os.environ["CUDA_VISIBLE_DEVICES"] = arguments.gpu
+    # before TensorFlow reserves the GPU memory
+    availableMemory = getAvailableMemory() if not arguments.batch_size else None
+    patchModelLoading(sorted(set(job[2] for job in jobs)))
+    patchPredict(availableMemory)
+    defmap_worker.predictBatchSize = arguments.batch_size
+
+    for dataset, prediction, model in jobs:
+        args = ["infer", "-t", dataset, "-p", prediction, "-o", model]
+        if arguments.gpu:
+            args += ["-g", arguments.gpu]
+        print("Inference of %s" % dataset, flush=True)
+        print(runScript(arguments.script, args, cwd), flush=True)
+
+    if arguments.average:
+        joblib.dump(averagePredictions([joblib.load(job[1]) for job in jobs]), arguments.average)
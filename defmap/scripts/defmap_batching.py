@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Batch size of the DefMap models chosen from the memory available for the
+inference, the GPU memory when the models run on a GPU and the RAM (or the
+memory limit of the container) otherwise. TensorFlow reserves most of the
+GPU memory when it loads the models, so the free memory is measured before.
+When a batch still runs out of memory it is halved and predicted again.
+"""
+
+import os
+import re
+import subprocess
+
+import numpy as np
+
+MEMORY_FRACTION = 0.5  # part of the available memory given to the batches
+ACTIVATION_FACTOR = 100  # memory of a sample relative to its input when the layers are unknown
+MAX_BATCH_SIZE = 4096
+FLOAT_SIZE = 4
+CGROUP_FILES = [("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")]
+
+
+def readNumber(fileName):
+    try:
+        with open(fileName) as numberFile:
+            return int(numberFile.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def getHostMemory():
+    """ Bytes of RAM available, within the memory limit of the container if there is one. """
+    available = None
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if available is None:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+    for limitFile, usageFile in CGROUP_FILES:
+        limit, usage = readNumber(limitFile), readNumber(usageFile)
+        if limit is not None and usage is not None:
+            available = min(available, max(limit - usage, 0))
+            break
+    return available
+
+
+def getGpuMemory():
+    """ Bytes free in the first GPU visible to the models, None without GPUs. """
+    devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if devices is not None and (not devices.strip() or devices.strip().startswith("-")):
+        return None  # GPUs hidden, the models run on the CPU
+
+    command = ["nvidia-smi", "--query-gpu=memory.free", "--format=csv,noheader,nounits"]
+    if devices:
+        command += ["-i", devices.split(",")[0].strip()]
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30)
+        return int(output.stdout.decode().split()[0]) * 1024 ** 2 if output.returncode == 0 else None
+    except (OSError, ValueError, IndexError, subprocess.TimeoutExpired):
+        return None
+
+
+def getSampleMemory(model):
+    """ Bytes used by one sub-voxel going through the model: its input and the
+    outputs of all the layers, or a multiple of the input when the layers
+    are not known (ONNX models). """
+    inputSize = int(np.prod([n for n in model.input_shape[1:] if n]))
+    layers = getattr(model, "layers", None)
+    if not layers:
+        return inputSize * FLOAT_SIZE * ACTIVATION_FACTOR
+
+    total = inputSize
+    for layer in layers:
+        shapes = layer.output_shape if isinstance(layer.output_shape, list) else [layer.output_shape]
+        total += sum(int(np.prod([n for n in shape[1:] if n])) for shape in shapes)
+    return total * FLOAT_SIZE
+
+
+def getAvailableMemory():
+    """ Bytes free in the GPU of the models, or in the RAM without GPUs. """
+    available = getGpuMemory()
+    return getHostMemory() if available is None else available
+
+
+def chooseBatchSize(model, maxBatchSize=MAX_BATCH_SIZE, available=None):
+    """ Largest batch size that keeps the samples of a batch within a part of
+    the available memory, measured now if not given. """
+    if available is None:
+        available = getAvailableMemory()
+    batchSize = int(available * MEMORY_FRACTION // getSampleMemory(model))
+    return max(1, min(batchSize, maxBatchSize))
+
+
+def isOutOfMemory(error):
+    """ Whether an error of TensorFlow, ONNX Runtime or NumPy comes from a lack of memory. """
+    if isinstance(error, MemoryError) or type(error).__name__ == "ResourceExhaustedError":
+        return True
+    return re.search(r"out of memory|\boom\b|bad_alloc|failed to allocate", str(error), re.IGNORECASE) is not None
+
+
+def predictWithBackoff(predict, x, batchSize):
+    """ predict(x, batchSize), halving the batch size while it runs out of
+    memory. Returns the predictions and the batch size that worked. """
+    while True:
+        try:
+            return predict(x, batchSize), batchSize
+        except Exception as error:
+            if batchSize == 1 or not isOutOfMemory(error):
+                raise
+            batchSize = max(1, batchSize // 2)
+            print("Out of memory, predicting again with a batch size of %d" % batchSize, flush=True)
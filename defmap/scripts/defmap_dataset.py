@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Sub-voxel datasets of DefMap built with NumPy. The map is memory mapped and
+the sub-voxels are extracted through strided views, chunk by chunk, so the
+memory used is bounded by the chunk size and not by the size of the map.
+
+This module is shared by the protocols and the scripts run inside the DefMap
+environment, so it only depends on NumPy (and joblib for .jbl files). The
+layout of the dataset and prediction files is defined here.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+SUBVOXEL_SIZE = 10  # edge of the sub-voxels, in voxels of 1.5 Å
+SUBVOXEL_THRESHOLD = 0.0  # minimum standardized intensity of a sub-voxel center
+CHUNK_SIZE = 4096  # sub-voxels extracted at once
+
+# Keys of the dataset and prediction files
+DATASET_DATA = "data"
+DATASET_CENTERS = "centers"
+PREDICTION_VALUES = "pred"
+PREDICTION_CENTERS = "centers"
+
+MRC_HEADER_SIZE = 1024
+MRC_MODES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16}  # mode -> dtype of the voxels
+SLAB_SIZE = 32  # z slices processed at once when going through a whole volume
+
+
+# --------------------------- MRC -----------------------------------
+
+def readMrcLayout(fileName):
+    """ Shape (z, y, x), dtype and offset of the voxels of an MRC file. """
+    words = np.fromfile(fileName, dtype=np.uint8, count=MRC_HEADER_SIZE)
+    byteOrder = '>' if words[212] == 0x11 else '<'
+    fields = words.view(np.dtype(byteOrder + 'i4'))
+
+    mode = int(fields[3])
+    if mode not in MRC_MODES:
+        raise Exception('MRC mode %d of %s is not supported' % (mode, fileName))
+
+    shape = tuple(int(n) for n in fields[2::-1])
+    dtype = np.dtype(MRC_MODES[mode]).newbyteorder(byteOrder)
+    return shape, dtype, MRC_HEADER_SIZE + int(fields[23])
+
+
+def mapMrc(fileName, mode='r'):
+    """ Memory map with (z, y, x) axes of the voxels of an MRC file. """
+    shape, dtype, offset = readMrcLayout(fileName)
+    return np.memmap(fileName, dtype=dtype, mode=mode, offset=offset, shape=shape)
+
+
+# --------------------------- SUB-VOXELS -----------------------------------
+
+def getStatistics(volume):
+    """ Mean and standard deviation of the volume, going through it slab by slab. """
+    total = squares = 0.0
+    for z in range(0, volume.shape[0], SLAB_SIZE):
+        slab = np.asarray(volume[z:z + SLAB_SIZE], dtype=np.float64)
+        total += slab.sum()
+        squares += np.square(slab).sum()
+
+    mean = total / volume.size
+    return mean, np.sqrt(max(squares / volume.size - mean ** 2, 0.0)) or 1.0
+
+
+def iterCenters(volume, mean, std, threshold=SUBVOXEL_THRESHOLD, size=SUBVOXEL_SIZE, mask=None):
+    """ Centers (z, y, x) of the sub-voxels to predict, slab by slab: voxels over
+    the threshold whose sub-voxel lies inside the map and, with a mask of the
+    same shape, whose mask is not zero. """
+    low = size // 2
+    high = size - low
+    lastZ = volume.shape[0] - high + 1
+    inner = slice(low, -high + 1 or None)
+
+    for z in range(low, lastZ, SLAB_SIZE):
+        region = (slice(z, min(z + SLAB_SIZE, lastZ)), inner, inner)
+        selected = (np.asarray(volume[region], dtype=np.float32) - mean) / std > threshold
+        if mask is not None:
+            selected &= np.asarray(mask[region]) != 0
+        centers = np.argwhere(selected).astype(np.int32)
+        if len(centers):
+            yield centers + np.array([z, low, low], dtype=np.int32)
+
+
+def extractSubvoxels(volume, centers, mean, std, size=SUBVOXEL_SIZE):
+    """ Standardized sub-voxels around the centers, as an (n, size, size, size, 1)
+    float32 array. The windows are strided views, only the selected ones are copied. """
+    windows = sliding_window_view(volume, (size, size, size))
+    corners = centers - size // 2
+    subvoxels = windows[corners[:, 0], corners[:, 1], corners[:, 2]].astype(np.float32)
+    subvoxels -= mean
+    subvoxels /= std
+    return subvoxels[..., None]
+
+
+def iterSubvoxels(volume, threshold=SUBVOXEL_THRESHOLD, size=SUBVOXEL_SIZE, chunkSize=CHUNK_SIZE,
+                  statistics=None, region=None, mask=None):
+    """ Generator of (centers, sub-voxels) chunks of at most chunkSize sub-voxels.
+
+    statistics is the (mean, std) used to standardize, computed from the volume
+    if not given. region is a (start, stop) pair of (z, y, x) corners: when
+    given, only the centers inside it are used. mask restricts the centers
+    to its non zero voxels, e.g. the protein mask of the preprocessing. """
+    if chunkSize <= 0:
+        raise ValueError("The chunk size must be positive, not %d" % chunkSize)
+    mean, std = statistics or getStatistics(volume)
+    pending = []
+    pendingSize = 0
+
+    for centers in iterCenters(volume, mean, std, threshold, size, mask):
+        if region is not None:
+            inside = np.all((centers >= region[0]) & (centers < region[1]), axis=1)
+            centers = centers[inside]
+        pending.append(centers)
+        pendingSize += len(centers)
+        while pendingSize >= chunkSize:
+            centers = np.concatenate(pending)
+            chunk, rest = centers[:chunkSize], centers[chunkSize:]
+            yield chunk, extractSubvoxels(volume, chunk, mean, std, size)
+            pending, pendingSize = [rest], len(rest)
+
+    if pendingSize:
+        centers = np.concatenate(pending)
+        yield centers, extractSubvoxels(volume, centers, mean, std, size)
+
+
+def iterTiles(shape, tileSize, size=SUBVOXEL_SIZE):
+    """ Tiles of a volume with the given shape. Every tile is a (block, region)
+    pair: block is the (start, stop) of the tile plus a halo large enough
+    for the sub-voxels of its borders, and region is the (start, stop) of the
+    tile inside the block, where its centers are. """
+    if tileSize <= 0:
+        raise ValueError("The tile size must be positive, not %d" % tileSize)
+    low = size // 2
+    high = size - low
+    shape = np.array(shape)
+
+    for z in range(0, shape[0], tileSize):
+        for y in range(0, shape[1], tileSize):
+            for x in range(0, shape[2], tileSize):
+                start = np.array([z, y, x])
+                stop = np.minimum(start + tileSize, shape)
+                blockStart = np.maximum(start - low, 0)
+                blockStop = np.minimum(stop + high - 1, shape)
+                yield (blockStart, blockStop), (start - blockStart, stop - blockStart)
+
+
+# --------------------------- FILES -----------------------------------
+
+def buildDataset(volume, fileName, threshold=SUBVOXEL_THRESHOLD, size=SUBVOXEL_SIZE, chunkSize=CHUNK_SIZE,
+                 mask=None):
+    """ Write the dataset of all the sub-voxels of the volume (inside the mask,
+    if given), as the one of "prep_dataset.py -p". Return the number of sub-voxels. """
+    import joblib
+
+    mean, std = getStatistics(volume)
+    count = sum(len(centers) for centers in iterCenters(volume, mean, std, threshold, size, mask))
+
+    data = np.empty((count, size, size, size, 1), dtype=np.float32)
+    centers = np.empty((count, 3), dtype=np.int32)
+    start = 0
+    for chunkCenters, subvoxels in iterSubvoxels(volume, threshold, size, chunkSize, (mean, std), mask=mask):
+        data[start:start + len(chunkCenters)] = subvoxels
+        centers[start:start + len(chunkCenters)] = chunkCenters
+        start += len(chunkCenters)
+
+    joblib.dump({DATASET_DATA: data, DATASET_CENTERS: centers}, fileName)
+    return count
+
+
+def compareDatasets(fileName, referenceFileName):
+    """ Largest difference between the sub-voxels of two datasets with the
+    same centers, e.g. one built with buildDataset and one by prep_dataset.py. """
+    import joblib
+
+    dataset = joblib.load(fileName)
+    reference = joblib.load(referenceFileName)
+
+    centers = np.asarray(dataset[DATASET_CENTERS])
+    referenceCenters = np.asarray(reference[DATASET_CENTERS])
+    if not np.array_equal(centers, referenceCenters):
+        raise Exception("The datasets have different sub-voxel centers (%d and %d sub-voxels)"
+                        % (len(centers), len(referenceCenters)))
+
+    data = np.asarray(dataset[DATASET_DATA], dtype=np.float32)
+    referenceData = np.asarray(reference[DATASET_DATA], dtype=np.float32).reshape(data.shape)
+    return float(np.abs(data - referenceData).max()) if len(data) else 0.0
+
+
+def iterDataset(fileName, chunkSize=CHUNK_SIZE):
+    """ Generator of (centers, sub-voxels) chunks of a dataset file, as the ones of iterSubvoxels. """
+    import joblib
+
+    if chunkSize <= 0:
+        raise ValueError("The chunk size must be positive, not %d" % chunkSize)
+
+    dataset = joblib.load(fileName, mmap_mode='r')
+    data = dataset[DATASET_DATA]
+    centers = np.asarray(dataset[DATASET_CENTERS])
+    shape = (-1,) + tuple(data.shape[1:4]) + (1,)
+
+    for start in range(0, len(centers), chunkSize):
+        yield centers[start:start + chunkSize], np.asarray(data[start:start + chunkSize], dtype=np.float32).reshape(shape)
+
+
+def savePrediction(fileName, centers, values):
+    import joblib
+    joblib.dump({PREDICTION_VALUES: np.asarray(values, dtype=np.float32),
+                 PREDICTION_CENTERS: np.asarray(centers, dtype=np.int32)}, fileName)
+
+
+def loadPrediction(fileName):
+    """ Centers (z, y, x) and predicted values of a prediction file. """
+    import joblib
+    prediction = joblib.load(fileName)
+    return np.asarray(prediction[PREDICTION_CENTERS]), np.asarray(prediction[PREDICTION_VALUES]).ravel()
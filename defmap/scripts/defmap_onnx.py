@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+ONNX version of the DefMap models, to predict on the CPU with ONNX Runtime
+instead of TensorFlow. The Keras models are exported once, optionally with
+float16 weights or dynamic int8 quantization, and every export is checked
+against TensorFlow on the sub-voxels of a reference map.
+
+It runs inside the DefMap environment, which needs tf2onnx, onnxruntime and
+onnxconverter-common for the export, and only onnxruntime to predict.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from defmap_dataset import mapMrc, iterSubvoxels
+
+QUANTIZATIONS = ["none", "float16", "int8"]
+# Largest absolute difference with TensorFlow accepted for each quantization
+TOLERANCES = {"none": 1e-3, "float16": 5e-2, "int8": 2e-1}
+CHECK_SIZE = 2048  # sub-voxels of the reference map compared
+OPSET = 13
+
+
+class OnnxModel:
+    """ ONNX Runtime session with the part of the Keras model interface used
+    by the inference scripts. """
+
+    def __init__(self, fileName, threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(fileName, options, providers=["CPUExecutionProvider"])
+        self.inputName = self.session.get_inputs()[0].name
+        self.input_shape = tuple(self.session.get_inputs()[0].shape)
+
+    def predict(self, x, batch_size=256):
+        outputs = [self.session.run(None, {self.inputName: np.ascontiguousarray(x[start:start + batch_size])})[0]
+                   for start in range(0, len(x), batch_size)]
+        return np.concatenate(outputs) if outputs else np.zeros((0, 1), dtype=np.float32)
+
+
+def exportModel(modelFile, outputFile, quantization="none"):
+    """ Write the Keras model as ONNX, with a free batch dimension. """
+    import tensorflow as tf
+    import tf2onnx
+
+    model = tf.keras.models.load_model(modelFile)
+    signature = (tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name="input"),)
+    floatFile = outputFile + ".float.onnx" if quantization != "none" else outputFile
+    tf2onnx.convert.from_keras(model, input_signature=signature, opset=OPSET, output_path=floatFile)
+
+    if quantization == "float16":
+        import onnx
+        from onnxconverter_common import float16
+        onnx.save(float16.convert_float_to_float16(onnx.load(floatFile), keep_io_types=True), outputFile)
+    elif quantization == "int8":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(floatFile, outputFile, weight_type=QuantType.QInt8)
+
+    if floatFile != outputFile:
+        os.remove(floatFile)
+    return model
+
+
+def checkModel(model, onnxFile, mapFile, size=CHECK_SIZE):
+    """ Differences between the predictions of the Keras model and its ONNX
+    version for the first sub-voxels of a map. """
+    _, subvoxels = next(iterSubvoxels(mapMrc(mapFile), chunkSize=size))
+    expected = model.predict(subvoxels).ravel()
+    predicted = OnnxModel(onnxFile).predict(subvoxels).ravel()
+
+    difference = np.abs(expected - predicted)
+    correlation = np.corrcoef(expected, predicted)[0, 1] if len(expected) > 1 else 1.0
+    return {"subvoxels": int(len(expected)), "maxError": float(difference.max()),
+            "meanError": float(difference.mean()), "correlation": float(correlation)}
+
+
+def getParser():
+    parser = argparse.ArgumentParser(description="Export a DefMap model to ONNX and check it")
+    parser.add_argument("--model", required=True, help="Keras model (.h5)")
+    parser.add_argument("--output", required=True, help="ONNX model to write")
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default="none")
+    parser.add_argument("--check-map", required=True, help="map whose sub-voxels are predicted by both models")
+    parser.add_argument("--report", default=None, help="json file for the results of the check")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="largest difference with TensorFlow accepted (depends on the quantization by default)")
+    return parser
+
+
+if __name__ == "__main__":
+    arguments = getParser().parse_args()
+    temporary = "%s.%d.tmp" % (arguments.output, os.getpid())  # runs may export the same model at once
+
+    model = exportModel(arguments.model, temporary, arguments.quantization)
+    report = checkModel(model, temporary, arguments.check_map)
+    report.update({"model": arguments.model, "quantization": arguments.quantization,
+                   "tolerance": arguments.tolerance or TOLERANCES[arguments.quantization]})
+    print(json.dumps(report, indent=2), flush=True)
+
+    if arguments.report:
+        with open(arguments.report, "w") as reportFile:
+            json.dump(report, reportFile, indent=2)
+
+    if report["maxError"] > report["tolerance"]:
+        os.remove(temporary)
+        sys.exit("The %s ONNX model differs from TensorFlow by %g, more than %g"
+                 % (arguments.quantization, report["maxError"], report["tolerance"]))
+    os.replace(temporary, arguments.output)
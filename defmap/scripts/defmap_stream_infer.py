@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Streaming DefMap inference. The sub-voxels are extracted from the map chunk
+by chunk and go straight through the models, without writing a dataset, so
+the memory used is bounded by the chunk size instead of the map size.
+
+Very large maps can also be split in tiles with halos, predicted in a pool of
+processes and stitched back into one prediction. A dataset already written
+can be predicted in chunks too, and the models can be ONNX exports run by
+ONNX Runtime instead of TensorFlow.
+
+With a shards folder, the predictions of every chunk are written to a
+numbered shard as soon as they are done. A run that was interrupted skips
+the shards already written when it is launched again, and the shards are
+merged into the prediction files at the end.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import zipfile
+
+import numpy as np
+
+from defmap_batching import getAvailableMemory, chooseBatchSize, predictWithBackoff
+from defmap_dataset import (CHUNK_SIZE, SUBVOXEL_SIZE, SUBVOXEL_THRESHOLD, mapMrc, getStatistics,
+                            iterSubvoxels, iterTiles, iterDataset, savePrediction)
+
+RUNTIME_TENSORFLOW = "tensorflow"
+RUNTIME_ONNX = "onnx"
+
+SHARDS_MANIFEST = "shards.json"
+
+# Models of the current process and their batch sizes
+models = []
+batchSizes = []
+
+
+def loadModels(modelFiles, gpu, size, runtime=RUNTIME_TENSORFLOW, threads=0, batchSize=0, processes=1):
+    """ Load the models of this process and choose their batch sizes, from the
+    memory of the processes when batchSize is 0. """
+    available = None
+    if runtime == RUNTIME_ONNX:
+        # ONNX Runtime on the CPU, TensorFlow is not loaded at all
+        from defmap_onnx import OnnxModel
+        models.extend(OnnxModel(model, threads) for model in modelFiles)
+    else:
+        if gpu:
+            os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+        if not batchSize:
+            # before TensorFlow reserves the GPU memory
+            available = getAvailableMemory()
+        import tensorflow as tf
+        models.extend(tf.keras.models.load_model(model) for model in modelFiles)
+
+    if models[0].input_shape[1] != size:
+        raise Exception("The models take sub-voxels of %d voxels, not %d" % (models[0].input_shape[1], size))
+
+    if not batchSize:
+        if available is None:
+            available = getAvailableMemory()
+        available //= processes
+    batchSizes.extend(batchSize or chooseBatchSize(model, available=available) for model in models)
+    print("Batch sizes: %s" % ", ".join(str(modelBatchSize) for modelBatchSize in batchSizes), flush=True)
+
+
+def getShardsManifest(arguments):
+    """ Arguments the predictions of the shards depend on. """
+    return {"source": os.path.abspath(arguments.map or arguments.dataset),
+            "models": [os.path.abspath(model) for model in arguments.models],
+            "mask": arguments.mask and os.path.abspath(arguments.mask),
+            "runtime": arguments.runtime,
+            "threshold": arguments.threshold,
+            "subvoxelSize": arguments.subvoxel_size,
+            "chunkSize": arguments.chunk_size,
+            "tileSize": arguments.tile_size}
+
+
+def prepareShards(arguments):
+    """ Create the shards folder, removing the shards of a run with other arguments. """
+    manifestFile = os.path.join(arguments.shards, SHARDS_MANIFEST)
+    manifest = getShardsManifest(arguments)
+    try:
+        with open(manifestFile) as previous:
+            if json.load(previous) == manifest:
+                return
+    except (OSError, ValueError):
+        pass
+
+    shutil.rmtree(arguments.shards, ignore_errors=True)
+    os.makedirs(arguments.shards)
+    with open(manifestFile, "w") as manifestOutput:
+        json.dump(manifest, manifestOutput)
+
+
+def getShardFile(arguments, tile, chunk):
+    return os.path.join(arguments.shards, "shard-%05d-%06d.npz" % (tile, chunk))
+
+
+def loadShard(fileName, centers):
+    """ Predictions of every model stored in a shard, None if it is not done
+    or was written for other centers. """
+    if not os.path.exists(fileName):
+        return None
+    try:
+        with np.load(fileName) as shard:
+            if np.array_equal(shard["centers"], centers):
+                return list(shard["values"])
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+    return None
+
+
+def saveShard(fileName, centers, values):
+    """ Write a shard under a temporary name and rename it, so a shard file is always complete. """
+    temporary = "%s.%d.tmp" % (fileName, os.getpid())
+    with open(temporary, "wb") as shardFile:
+        np.savez(shardFile, centers=centers, values=np.stack(values))
+        shardFile.flush()
+        os.fsync(shardFile.fileno())
+    os.replace(temporary, fileName)
+
+
+def predictRegion(mapFile, block, region, statistics, arguments, tile=0):
+    """ Centers and predictions of every model for the centers in the region
+    of the block (start, stop) of the map. """
+    volume = mapMrc(mapFile)
+    mask = mapMrc(arguments.mask) if arguments.mask else None
+    if block is not None:
+        blockSlices = tuple(slice(start, stop) for start, stop in zip(*block))
+        volume = volume[blockSlices]
+        if mask is not None:
+            mask = mask[blockSlices]
+
+    chunks = iterSubvoxels(volume, arguments.threshold, arguments.subvoxel_size,
+                           arguments.chunk_size, statistics, region, mask)
+    centers, values = predictChunks(chunks, arguments, tile)
+
+    if block is not None:
+        centers += np.asarray(block[0], dtype=np.int32)
+    return centers, values
+
+
+def predictChunks(chunks, arguments, tile=0):
+    """ Centers and predictions of every model for (centers, sub-voxels)
+    chunks. With shards, the chunks already predicted are read from them. """
+    centers = [np.zeros((0, 3), dtype=np.int32)]
+    values = [[np.zeros(0, dtype=np.float32)] for _ in models]
+
+    skipped = predicted = 0
+    for chunk, (chunkCenters, subvoxels) in enumerate(chunks):
+        shardFile = getShardFile(arguments, tile, chunk) if arguments.shards else None
+        chunkValues = loadShard(shardFile, chunkCenters) if shardFile else None
+
+        if chunkValues is None:
+            if arguments.max_chunks and predicted == arguments.max_chunks:
+                sys.exit("Stopped after predicting %d chunks" % predicted)
+            predicted += 1
+            chunkValues = []
+            for i, model in enumerate(models):
+                predictions, batchSizes[i] = predictWithBackoff(
+                    lambda data, size: model.predict(data, batch_size=size), subvoxels, batchSizes[i])
+                chunkValues.append(predictions.ravel().astype(np.float32))
+            if shardFile:
+                saveShard(shardFile, chunkCenters, chunkValues)
+        else:
+            skipped += 1
+
+        centers.append(chunkCenters)
+        for modelValues, predictions in zip(values, chunkValues):
+            modelValues.append(predictions)
+
+    if skipped:
+        print("Read %d chunks of tile %d from the shards of a previous run" % (skipped, tile), flush=True)
+
+    return np.concatenate(centers), [np.concatenate(modelValues) for modelValues in values]
+
+
+def predictTile(task):
+    return predictRegion(*task)
+
+
+def getParser():
+    parser = argparse.ArgumentParser(description="DefMap streaming inference")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-m", "--map", help="map to predict")
+    source.add_argument("-d", "--dataset", help="dataset to predict instead of a map")
+    parser.add_argument("--models", nargs="+", required=True, help="trained models")
+    parser.add_argument("--outputs", nargs="+", required=True, help="prediction file of each model")
+    parser.add_argument("--average", default=None,
+                        help="file to write the average of the predictions of all the models")
+    parser.add_argument("--mask", default=None,
+                        help="mask of the map, only its non zero voxels are predicted")
+    parser.add_argument("-t", "--threshold", type=float, default=SUBVOXEL_THRESHOLD,
+                        help="minimum standardized intensity of the sub-voxel centers")
+    parser.add_argument("--subvoxel-size", type=int, default=SUBVOXEL_SIZE, help="edge of the sub-voxels")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="sub-voxels extracted at once")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="batch size of the models, 0 to choose it from the available memory")
+    parser.add_argument("--tile-size", type=int, default=0, help="edge of the tiles, 0 to predict the whole map")
+    parser.add_argument("--processes", type=int, default=1, help="processes predicting tiles")
+    parser.add_argument("--runtime", choices=[RUNTIME_TENSORFLOW, RUNTIME_ONNX], default=RUNTIME_TENSORFLOW,
+                        help="models are Keras models run by TensorFlow or ONNX models run by ONNX Runtime")
+    parser.add_argument("--threads", type=int, default=0, help="threads of each ONNX Runtime session")
+    parser.add_argument("--shards", default=None,
+                        help="folder to keep the predictions of every chunk and resume an interrupted run")
+    parser.add_argument("--max-chunks", type=int, default=0,
+                        help="fail after predicting this many chunks, as an interrupted run (for tests)")
+    parser.add_argument("-g", "--gpu", default=None, help="GPUs to use")
+    return parser
+
+
+if __name__ == "__main__":
+    arguments = getParser().parse_args()
+    if len(arguments.models) != len(arguments.outputs):
+        raise Exception("There must be one output for each model")
+
+    modelArgs = (arguments.models, arguments.gpu, arguments.subvoxel_size, arguments.runtime, arguments.threads,
+                 arguments.batch_size, arguments.processes if arguments.tile_size else 1)
+    if arguments.shards:
+        prepareShards(arguments)
+
+    if arguments.dataset:
+        loadModels(*modelArgs)
+        centers, values = predictChunks(iterDataset(arguments.dataset, arguments.chunk_size), arguments)
+    elif arguments.tile_size:
+        # the standardization of every tile must be the one of the whole map
+        statistics = getStatistics(mapMrc(arguments.map))
+        shape = mapMrc(arguments.map).shape
+        tasks = [(arguments.map, block, region, statistics, arguments, tile)
+                 for tile, (block, region) in enumerate(iterTiles(shape, arguments.tile_size,
+                                                                  arguments.subvoxel_size))]
+
+        # spawn, so TensorFlow is only loaded in the workers
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(arguments.processes, initializer=loadModels, initargs=modelArgs) as pool:
+            results = []
+            for result in pool.imap_unordered(predictTile, tasks):
+                results.append(result)
+                print("Predicted tile %d of %d" % (len(results), len(tasks)), flush=True)
+
+        centers = np.concatenate([result[0] for result in results])
+        values = [np.concatenate([result[1][i] for result in results]) for i in range(len(arguments.models))]
+
+        order = np.lexsort(centers.T[::-1])
+        centers = centers[order]
+        values = [modelValues[order] for modelValues in values]
+    else:
+        loadModels(*modelArgs)
+        centers, values = predictRegion(arguments.map, None, None, None, arguments)
+
+    print("Predicted %d sub-voxels" % len(centers), flush=True)
+
+    for output, modelValues in zip(arguments.outputs, values):
+        savePrediction(output, centers, modelValues)
+
+    if arguments.average:
+        savePrediction(arguments.average, centers, np.mean(values, axis=0))
+
+    if arguments.shards:
+        # the shards are merged into the predictions
+        shutil.rmtree(arguments.shards)
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Long-lived DefMap inference worker. It runs inside the DefMap conda
+environment, keeps TensorFlow and the trained models loaded and runs the
+"3dcnn_main.py infer" requests received on a Unix socket. It exits after
+being idle for a while.
+
+A worker serves the GPUs it was started with, so there is one worker (and
+one socket) per GPU list. Pings are answered while an inference runs, and
+the socket is only replaced when no worker answers on it.
+
+The client functions at the end are used by the protocol, so this module
+only depends on the standard library.
+"""
+
+import argparse
+import fcntl
+import importlib
+import io
+import json
+import os
+import runpy
+import socket
+import sys
+import threading
+import time
+import traceback
+from contextlib import redirect_stdout
+
+MODEL_MODULES = ["tensorflow.keras.models", "keras.models"]
+STATUS_OK = "ok"
+STATUS_LOADING = "loading"  # the worker answers but is still loading TensorFlow and the models
+PING_TIMEOUT = 5
+
+# Batch size forced on every Model.predict call: None keeps the one of the
+# caller and 0 chooses it from the available memory
+predictBatchSize = None
+
+
+# --------------------------- WORKER -----------------------------------
+
+def patchModelLoading(modelFiles):
+    """ Replace keras load_model by a version that keeps every loaded model,
+    and load the given models right away. """
+    import tensorflow as tf
+
+    loadModel = tf.keras.models.load_model
+    models = {}
+
+    def loadCachedModel(filepath, *args, **kwargs):
+        key = os.path.abspath(str(filepath))
+        if key not in models:
+            models[key] = loadModel(filepath, *args, **kwargs)
+        return models[key]
+
+    tf.keras.models.load_model = loadCachedModel
+    for name in MODEL_MODULES:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+        module.load_model = loadCachedModel
+
+    for modelFile in modelFiles:
+        loadCachedModel(modelFile)
+
+
+def patchPredict(availableMemory=None):
+    """ Make Model.predict use predictBatchSize when it is set, whatever batch
+    size the inference script asks for, and retry with smaller batches when
+    it runs out of memory. Automatic batch sizes come from availableMemory,
+    measured before TensorFlow reserved the GPU memory. """
+    import tensorflow as tf
+    from defmap_batching import chooseBatchSize, predictWithBackoff
+
+    predict = tf.keras.Model.predict
+    batchSizes = {}  # automatic batch size of each model, kept after backing off
+
+    def predictInBatches(self, x, *args, **kwargs):
+        if predictBatchSize is None:
+            return predict(self, x, *args, **kwargs)
+
+        args = args[1:]
+        kwargs.pop("batch_size", None)
+        batchSize = (predictBatchSize or batchSizes.get(id(self))
+                     or chooseBatchSize(self, available=availableMemory))
+        values, batchSize = predictWithBackoff(lambda data, size: predict(self, data, size, *args, **kwargs),
+                                               x, batchSize)
+        if not predictBatchSize:
+            batchSizes[id(self)] = batchSize
+        return values
+
+    tf.keras.Model.predict = predictInBatches
+
+
+def runScript(script, args, cwd):
+    """ Run the inference script as if it was called from the command line. """
+    argv = sys.argv
+    sys.argv = [script] + args
+    log = io.StringIO()
+    try:
+        os.chdir(cwd)
+        with redirect_stdout(log):
+            runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code:
+            raise Exception("%s exited with code %s" % (script, e.code))
+    finally:
+        sys.argv = argv
+    return log.getvalue()
+
+
+def handleRequest(request, script, gpu):
+    command = request.get("command")
+
+    if command == "infer":
+        if (request.get("gpu") or "") != gpu:
+            return {"status": "error",
+                    "message": "This worker runs on GPUs '%s', not '%s'" % (gpu, request.get("gpu") or "")}
+        global predictBatchSize
+        predictBatchSize = request.get("batchSize", 0)
+        try:
+            output = runScript(script, request["args"], request.get("cwd", os.getcwd()))
+            return {"status": STATUS_OK, "output": output}
+        except Exception:
+            return {"status": "error", "message": traceback.format_exc()}
+    else:
+        return {"status": "error", "message": "Unknown command %s" % command}
+
+
+def bindSocket(socketPath):
+    """ Listening socket at socketPath and its inode, or None if another
+    worker answers there. The socket of a worker that died is replaced. """
+    with open(socketPath + ".lock", "w") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        if os.path.exists(socketPath):
+            if pingWorker(socketPath) is not None:
+                return None
+            os.remove(socketPath)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socketPath)
+        os.chmod(socketPath, 0o600)
+        server.listen(8)
+        return server, os.stat(socketPath).st_ino
+
+
+def removeSocket(socketPath, inode):
+    """ Remove the socket file only if it is still the one of this worker. """
+    with open(socketPath + ".lock", "w") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        if os.path.exists(socketPath) and os.stat(socketPath).st_ino == inode:
+            os.remove(socketPath)
+
+
+def serve(server, script, idleTimeout, modelFiles, gpu):
+    """ Answer the requests while the models load and until the worker is
+    idle for idleTimeout seconds. Every connection has its thread, and the
+    inferences run one at a time. """
+    ready = threading.Event()
+    stop = threading.Event()
+    inferenceLock = threading.Lock()
+    activity = {"last": time.time(), "running": 0}
+
+    def load():
+        from defmap_batching import getAvailableMemory
+        availableMemory = getAvailableMemory()
+        patchModelLoading(modelFiles)
+        patchPredict(availableMemory)
+        ready.set()
+        print("DefMap worker ready", flush=True)
+
+    def answer(connection):
+        with connection:
+            connection.settimeout(None)
+            request = receiveMessage(connection)
+            command = request.get("command")
+            if command == "ping":
+                sendMessage(connection, {"status": STATUS_OK if ready.is_set() else STATUS_LOADING})
+            elif command == "shutdown":
+                sendMessage(connection, {"status": STATUS_OK})
+                stop.set()
+            else:
+                ready.wait()
+                with inferenceLock:
+                    activity["running"] += 1
+                    try:
+                        response = handleRequest(request, script, gpu)
+                    finally:
+                        activity["running"] -= 1
+                        activity["last"] = time.time()
+                sendMessage(connection, response)
+
+    threading.Thread(target=load, daemon=True).start()
+    server.settimeout(1)
+
+    while not stop.is_set():
+        try:
+            connection, _ = server.accept()
+        except socket.timeout:
+            if not activity["running"] and time.time() - activity["last"] > idleTimeout:
+                print("Idle for %d seconds, shutting down" % idleTimeout, flush=True)
+                break
+            continue
+        activity["last"] = time.time()
+        threading.Thread(target=answer, args=(connection,), daemon=True).start()
+
+    server.close()
+
+
+# --------------------------- CLIENT -----------------------------------
+
+def sendMessage(connection, message):
+    connection.sendall(json.dumps(message).encode() + b"\n")
+
+
+def receiveMessage(connection):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode())
+
+
+def sendRequest(socketPath, request, timeout=None):
+    """ Send a request to the worker and return its response. """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(socketPath)
+        sendMessage(connection, request)
+        return receiveMessage(connection)
+
+
+def pingWorker(socketPath):
+    """ Status of the worker listening at socketPath, None if there is none. """
+    try:
+        return sendRequest(socketPath, {"command": "ping"}, timeout=PING_TIMEOUT)["status"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def isWorkerRunning(socketPath):
+    """ Whether a worker answers at socketPath, even if it is still loading the models. """
+    return pingWorker(socketPath) is not None
+
+
+def waitForWorker(socketPath, timeout):
+    """ Wait until the worker is ready, as it has to load TensorFlow and the models first. """
+    start = time.time()
+    while time.time() - start < timeout:
+        if pingWorker(socketPath) == STATUS_OK:
+            return True
+        time.sleep(1)
+    return False
+
+
+# --------------------------- MAIN -----------------------------------
+
+def getParser():
+    parser = argparse.ArgumentParser(description="DefMap inference worker")
+    parser.add_argument("--socket", required=True, help="Unix socket to listen on")
+    parser.add_argument("--script", required=True, help="path to 3dcnn_main.py")
+    parser.add_argument("--models", nargs="*", default=[], help="models to load at start")
+    parser.add_argument("-g", "--gpu", default="", help="GPUs of the worker, all of them if not given")
+    parser.add_argument("--idle-timeout", type=int, default=1800,
+                        help="seconds without requests before shutting down")
+    return parser
+
+
+if __name__ == "__main__":
+    arguments = getParser().parse_args()
+    bound = bindSocket(arguments.socket)
+    if bound is None:
+        print("Another DefMap worker is listening on %s" % arguments.socket, flush=True)
+        sys.exit(0)
+
+    server, inode = bound
+    if arguments.gpu:
+        # before TensorFlow is loaded, it cannot change later
+        os.environ["CUDA_VISIBLE_DEVICES"] = arguments.gpu
+    sys.path.insert(0, os.path.dirname(os.path.abspath(arguments.script)))
+    print("DefMap worker listening on %s" % arguments.socket, flush=True)
+    try:
+        serve(server, arguments.script, arguments.idle_timeout, arguments.models, arguments.gpu)
+    finally:
+        removeSocket(arguments.socket, inode)
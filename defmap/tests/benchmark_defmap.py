@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Sofía González Matatoros (sofia.gonzalezm@estudiante.uam.es)
+# *
+# * Centro Nacional de Biotecnología CNB - Universidad Autónoma de Madrid UAM
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Offline benchmark of the stages of the DefMap pipeline that run inside
+Scipion. Synthetic maps of increasing size are made by tiling the bundled
+emd_4054.mrc, with the matching copies of 5lij.pdb as atomic structure, so
+no network or DefMap environment is needed. Every stage runs in a process
+of its own, to measure its peak memory, and the results are saved as JSON
+to compare them between commits:
+
+    scipion3 python -m defmap.tests.benchmark_defmap -o benchmark.json --compare previous.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from defmap.constants import MAPPING_NEAREST, MAPPING_RADIUS, MAPPING_TRILINEAR
+from defmap.convert import (MrcVolume, createMrc, updateMrcStatistics, readMrc, readPdbAtoms,
+                            getPdbCoordinates, formatColumn, predictionToGridPdb, readCaAtoms,
+                            PDB_COORDINATES, PDB_SERIAL, PDB_RESIDUE)
+from defmap.mapping import predictionToModel
+from defmap.perf import RSS_UNIT, getUsage, getMeasure
+from defmap.preprocessing import preprocessVolume
+from defmap.scripts.defmap_dataset import (getStatistics, iterCenters, iterSubvoxels, buildDataset,
+                                           savePrediction)
+
+TESTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SEED_MAP = os.path.join(TESTS_FOLDER, 'emd_4054.mrc')
+SEED_STRUCTURE = os.path.join(TESTS_FOLDER, '5lij.pdb')
+SEED_SAMPLING = 1.38  # Å/px of emd_4054, as in the tests
+SEED_SIZE = 64
+
+SIZES = [64, 128, 256, 512]
+DATASET_LIMIT = 128  # bigger datasets do not fit in memory
+RESOLUTION = 5.0
+CHAINS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+CHAIN_COLUMN = 21
+RESIDUE_OFFSET = 200  # residues of 5lij are numbered up to 152
+
+
+# --------------------------- SYNTHETIC INPUTS -----------------------------------
+
+def createMap(fileName, size):
+    """ Map of size³ voxels with copies of the seed map, written slab by slab. """
+    seed = np.asarray(readMrc(SEED_MAP), dtype=np.float32)
+    copies = size // SEED_SIZE
+    output = createMrc(fileName, (size, size, size), SEED_SAMPLING)
+    for z in range(0, size, SEED_SIZE):
+        output[z:z + SEED_SIZE] = np.tile(seed, (1, copies, copies))
+    output.flush()
+    del output
+    updateMrcStatistics(fileName)
+
+
+def createStructure(fileName, size):
+    """ Copies of the seed structure placed on the copies of the seed map, each
+    one with a chain of its own, so the atom count grows with the map. """
+    _, _, records = readPdbAtoms(SEED_STRUCTURE)
+    coordinates = getPdbCoordinates(records)
+    copies = size // SEED_SIZE
+    residues = np.asarray(records[:, PDB_RESIDUE[0]:PDB_RESIDUE[0] + PDB_RESIDUE[1]]
+                          .copy().view('S%d' % PDB_RESIDUE[1]).ravel().astype(np.int64))
+
+    with open(fileName, 'wb') as pdbFile:
+        for copy, (z, y, x) in enumerate(np.ndindex(copies, copies, copies)):
+            block = records.copy()
+            shift = np.array([x, y, z]) * SEED_SIZE * SEED_SAMPLING
+            for axis, (first, width) in enumerate(PDB_COORDINATES):
+                block[:, first:first + width] = formatColumn(coordinates[:, axis] + shift[axis], width, 3)
+            serials = copy * len(records) + np.arange(1, len(records) + 1)
+            block[:, PDB_SERIAL[0]:sum(PDB_SERIAL)] = formatColumn(serials % 100000, PDB_SERIAL[1])
+            block[:, PDB_RESIDUE[0]:sum(PDB_RESIDUE)] = formatColumn(
+                residues + (copy // len(CHAINS)) * RESIDUE_OFFSET, PDB_RESIDUE[1])
+            block[:, CHAIN_COLUMN] = ord(CHAINS[copy % len(CHAINS)])
+
+            lines = np.hstack([block, np.full((len(block), 1), ord('\n'), dtype=np.uint8)])
+            pdbFile.write(lines.tobytes())
+        pdbFile.write(b"END\n")
+    return copies ** 3 * len(records)
+
+
+def createPrediction(fileName, mapFileName, seed=0):
+    """ Random prediction at the sub-voxel centers of a map. """
+    volume = readMrc(mapFileName)
+    mean, std = getStatistics(volume)
+    centers = np.concatenate(list(iterCenters(volume, mean, std)) or [np.empty((0, 3), dtype=np.int64)])
+    values = np.random.default_rng(seed).normal(size=len(centers))
+    savePrediction(fileName, centers, values)
+    return len(centers)
+
+
+# --------------------------- STAGES -----------------------------------
+
+def preprocessStage(mapFileName, outputFileName):
+    preprocessVolume(mapFileName, outputFileName, SEED_SAMPLING, RESOLUTION)
+    return {'voxels': int(np.prod(MrcVolume(outputFileName).getDimensions()))}
+
+
+def subvoxelStage(mapFileName):
+    """ Extraction of all the sub-voxels in chunks, as the streamed inference does. """
+    count = sum(len(centers) for centers, _ in iterSubvoxels(readMrc(mapFileName)))
+    return {'subvoxels': count}
+
+
+def datasetStage(mapFileName, datasetFileName):
+    return {'subvoxels': buildDataset(readMrc(mapFileName), datasetFileName)}
+
+
+def voxelPdbStage(predictionFileName, mapFileName, outputFileName):
+    predictionToGridPdb(predictionFileName, mapFileName, outputFileName)
+    return {'bytes': os.path.getsize(outputFileName)}
+
+
+def mappingStage(predictionFileName, mapFileName, structureFileName, outputFileName, method):
+    predictionToModel(predictionFileName, mapFileName, structureFileName, outputFileName, method=method)
+    return {}
+
+
+def viewerStage(modelFileName, structureFileName):
+    """ Parsing and statistics done by the viewer to plot the prediction against the B-factors. """
+    from scipy.stats import pearsonr, linregress
+    from defmap.viewers.viewer_defmap import DefmapViewer
+
+    model = readCaAtoms(modelFileName)
+    structure = readCaAtoms(structureFileName)
+    predicted = DefmapViewer.getBfactors(None, DefmapViewer.getAtomList(None, model))
+    bfactors = DefmapViewer.getBfactors(None, DefmapViewer.getAtomList(None, structure))
+    pearsonr(predicted, bfactors)
+    linregress(predicted, bfactors)
+    return {'alphaCarbons': len(predicted)}
+
+
+def measureStage(stage, args, queue):
+    start, before = time.time(), getUsage()
+    info = stage(*args)
+    measure = getMeasure(start, before, getUsage())
+    measure['baselineRss'] = before[0].ru_maxrss * RSS_UNIT  # memory used before the stage
+    measure.update(info)
+    queue.put(measure)
+
+
+def runStage(stage, *args):
+    """ Run a stage in a new process and return its measures. """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measureStage, args=(stage, args, queue))
+    process.start()
+    measure = queue.get()
+    process.join()
+    return measure
+
+
+# --------------------------- BENCHMARK -----------------------------------
+
+def benchmarkSize(size, folder, datasetLimit=DATASET_LIMIT, log=print):
+    """ Measures of every stage for a map of size³ voxels. """
+    mapFile = os.path.join(folder, 'map_%d.mrc' % size)
+    structureFile = os.path.join(folder, 'structure_%d.pdb' % size)
+    preprocessedFile = os.path.join(folder, 'preprocessed_%d.mrc' % size)
+    predictionFile = os.path.join(folder, 'prediction_%d.jbl' % size)
+    modelFile = os.path.join(folder, 'model_%d.pdb' % size)
+
+    createMap(mapFile, size)
+    atoms = createStructure(structureFile, size)
+
+    createPrediction(predictionFile, mapFile)
+
+    # the preprocessing keeps only the biggest molecule, so the next stages use
+    # the synthetic map itself, as the protocol does without preprocessing
+    stages = [('preprocess', preprocessStage, (mapFile, preprocessedFile)),
+              ('subvoxels', subvoxelStage, (mapFile,))]
+    if size <= datasetLimit:
+        stages.append(('dataset', datasetStage, (mapFile, os.path.join(folder, 'sample_%d.jbl' % size))))
+    stages.append(('voxelPdb', voxelPdbStage, (predictionFile, mapFile, os.path.join(folder, 'voxels_%d.pdb' % size))))
+    for name, method in [('mappingNearest', MAPPING_NEAREST), ('mappingRadius', MAPPING_RADIUS),
+                         ('mappingTrilinear', MAPPING_TRILINEAR)]:
+        stages.append((name, mappingStage, (predictionFile, mapFile, structureFile, modelFile, method)))
+    stages.append(('viewer', viewerStage, (modelFile, structureFile)))
+
+    results = []
+    for name, stage, args in stages:
+        measure = runStage(stage, *args)
+        measure.update({'stage': name, 'size': size, 'atoms': atoms})
+        log('%-18s %4d³ %8.2f s %8.0f MB' % (name, size, measure['wall'], measure['peakRss'] / 1024 ** 2))
+        results.append(measure)
+
+    for fileName in os.listdir(folder):
+        os.remove(os.path.join(folder, fileName))
+    return results
+
+
+def getCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=TESTS_FOLDER,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareResults(results, previous):
+    """ Lines with the change of wall time and peak memory of every stage against previous results. """
+    reference = {(entry['stage'], entry['size']): entry for entry in previous['results']}
+    lines = ['%-18s %6s %14s %14s' % ('Stage', 'Size', 'Wall ratio', 'Memory ratio')]
+    for entry in results['results']:
+        old = reference.get((entry['stage'], entry['size']))
+        if old:
+            lines.append('%-18s %6d %14.2f %14.2f' % (entry['stage'], entry['size'],
+                                                      entry['wall'] / max(old['wall'], 1e-9),
+                                                      entry['peakRss'] / max(old['peakRss'], 1)))
+    return lines
+
+
+def getParser():
+    parser = argparse.ArgumentParser(description="Benchmark of the DefMap pipeline stages on synthetic maps")
+    parser.add_argument("-o", "--output", default="defmap_benchmark.json", help="JSON file for the results")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="edges of the synthetic maps, multiples of %d" % SEED_SIZE)
+    parser.add_argument("--dataset-limit", type=int, default=DATASET_LIMIT,
+                        help="biggest map whose whole dataset is built in memory")
+    parser.add_argument("--folder", default=None, help="folder for the synthetic files (a temporary one by default)")
+    parser.add_argument("--compare", default=None, help="results of a previous benchmark to compare with")
+    return parser
+
+
+def main():
+    arguments = getParser().parse_args()
+    for size in arguments.sizes:
+        if size % SEED_SIZE:
+            raise Exception('The size of the maps must be a multiple of %d' % SEED_SIZE)
+
+    results = {'commit': getCommit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'platform': platform.platform(), 'python': platform.python_version(),
+               'numpy': np.__version__, 'cpus': os.cpu_count(), 'results': []}
+
+    with tempfile.TemporaryDirectory(dir=arguments.folder) as folder:
+        for size in arguments.sizes:
+            results['results'] += benchmarkSize(size, folder, arguments.dataset_limit)
+
+    with open(arguments.output, 'w') as outputFile:
+        json.dump(results, outputFile, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare) as previousFile:
+            print('\n'.join(compareResults(results, json.load(previousFile))))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,18 @@
 # imports
 
+import gzip
+import os
+import shutil
+from glob import glob
+import numpy as np
 from pyworkflow.tests import BaseTest, setupTestProject
+from defmap import Plugin
 from defmap.constants import *
-from defmap.protocols import DefMapNeuralNetwork
+from defmap.protocols import DefMapNeuralNetwork, DefMapNeuralNetworkBatch
 from pyworkflow import Config
+from defmap.scripts.defmap_dataset import compareDatasets, iterSubvoxels, iterTiles, loadPrediction
+from defmap.perf import PERF_FILE, readMeasures
+from defmap.convert import MrcVolume, readMrc, readVoxelPredictions, readCaAtoms
 
 from pwem.protocols import ProtImportVolumes, ProtImportPdb
 
@@ -41,6 +50,18 @@ class TestDefmap(BaseTest):
         cls.protImportPdb.setObjLabel('inputStructure - pdb')
         cls.launchProtocol(cls.protImportPdb)
 
+        # Imports for the batch tests
+
+        volumesFolder = os.path.abspath(cls.proj.getTmpPath('batch_volumes'))
+        os.makedirs(volumesFolder, exist_ok=True)
+        for name in ['emd_4054_1.mrc', 'emd_4054_2.mrc']:
+            shutil.copy(mrcFile, os.path.join(volumesFolder, name))
+
+        cls.protImportVolumes = cls.newProtocol(ProtImportVolumes, importFrom=ProtImportVolumes.IMPORT_FROM_FILES,
+                                       filesPath=volumesFolder, filesPattern='*.mrc', samplingRate="1.38")
+        cls.protImportVolumes.setObjLabel('inputVolumes - mrc')
+        cls.launchProtocol(cls.protImportVolumes)
+
 
     def testNothing(self):
         return
@@ -53,6 +74,13 @@ class TestDefmap(BaseTest):
         self.launchProtocol(defmap)
         self.assertTrue(hasattr(defmap, "outputStructureVoxel"))
         self.assertFalse(hasattr(defmap, "outputStructure"))
+        # the prediction of 3dcnn_main.py only goes through its own scripts
+        self.assertFalse(hasattr(defmap, "outputPredictions"))
+        self.assertFalse(hasattr(defmap, "outputFlexibility"))
+
+        measures = readMeasures(defmap._getExtraPath(PERF_FILE))
+        self.assertIn("inferenceStep", measures)
+        self.assertIn("createOutputStep", measures)
 
     def testDefmap2(self):
         defmap = self.newProtocol(DefMapNeuralNetwork,
@@ -72,3 +100,275 @@ class TestDefmap(BaseTest):
         self.launchProtocol(defmap)
         self.assertTrue(hasattr(defmap, "outputStructureVoxel"))
         self.assertTrue(hasattr(defmap, "outputStructure"))
+
+    def testDefmapNumpyPreprocess(self):
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     inputStructure=self.protImportPdb.outputPdb,
+                                     inputPreprocess=True,
+                                     preprocessEngine=PREPROCESS_NUMPY
+                                     )
+        self.launchProtocol(defmap)
+        self.assertTrue(hasattr(defmap, "outputStructureVoxel"))
+        self.assertTrue(hasattr(defmap, "outputVolume"))
+        self.assertTrue(os.path.exists(defmap._getExtraPath('output_volumeM.mrc')))
+
+    def testDefmapAllModels(self):
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     inputStructure=self.protImportPdb.outputPdb,
+                                     inputResolution=RESOLUTION_ALL
+                                     )
+        self.launchProtocol(defmap)
+        self.assertTrue(hasattr(defmap, "outputStructureVoxel"))
+        self.assertTrue(hasattr(defmap, "outputStructure"))
+        for resolution in ["5A", "6A", "7A"]:
+            self.assertTrue(hasattr(defmap, "outputStructureVoxel" + resolution))
+            self.assertTrue(hasattr(defmap, "outputStructure" + resolution))
+
+    def testDefmapStream(self):
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     inputStructure=self.protImportPdb.outputPdb,
+                                     streamDataset=True,
+                                     chunkSize=1024
+                                     )
+        self.launchProtocol(defmap)
+        self.assertTrue(hasattr(defmap, "outputStructureVoxel"))
+        self.assertTrue(hasattr(defmap, "outputStructure"))
+
+        self.assertTrue(hasattr(defmap, "outputPredictions"))
+        coordinates, values = readVoxelPredictions(defmap.outputPredictions.getFileName())
+        self.assertEqual(coordinates.shape, (len(values), 3))
+
+        self.assertTrue(hasattr(defmap, "outputFlexibility"))
+        self.assertEqual(defmap.outputFlexibility.getDim(), MrcVolume(defmap._getExtraPath('volumes.mrc')).getDimensions())
+        # only the predicted voxels have a value
+        flexibility = readMrc(defmap.outputFlexibility.getFileName())
+        self.assertEqual(np.count_nonzero(~np.isnan(flexibility)), len(values))
+
+        # the sampling rate of the import (1.38 Å/px), not the one of the map header
+        inputVolume = self.protImportMrc.outputVolume
+        self.assertAlmostEqual(defmap.outputFlexibility.getSamplingRate(), inputVolume.getSamplingRate())
+        self.assertEqual(defmap.outputFlexibility.getOrigin(force=True).getShifts(),
+                         inputVolume.getOrigin(force=True).getShifts())
+
+    def testDefmapStreamPreprocess(self):
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     inputStructure=self.protImportPdb.outputPdb,
+                                     inputPreprocess=True,
+                                     preprocessEngine=PREPROCESS_NUMPY,
+                                     streamDataset=True
+                                     )
+        self.launchProtocol(defmap)
+        # the flexibility is on the grid of the preprocessed volume
+        self.assertAlmostEqual(defmap.outputFlexibility.getSamplingRate(), 1.5)
+        self.assertEqual(defmap.outputFlexibility.getDim(), defmap.outputVolume.getDim())
+
+    def testDefmapNumpyDataset(self):
+        # the NumPy builder must give the dataset of prep_dataset.py, on the map and on the preprocessed one
+        for preprocess in [False, True]:
+            datasets = []
+            for builder in [DATASET_SCRIPT, DATASET_NUMPY]:
+                defmap = self.newProtocol(DefMapNeuralNetwork,
+                                             inputVolume=self.protImportMrc.outputVolume,
+                                             inputStructure=self.protImportPdb.outputPdb,
+                                             inputPreprocess=preprocess,
+                                             datasetBuilder=builder,
+                                             useCache=False
+                                             )
+                self.launchProtocol(defmap)
+                self.assertTrue(hasattr(defmap, "outputStructure"))
+                datasets.append(defmap._getExtraPath('sample.jbl'))
+
+            # compareDatasets fails if the sub-voxel centers are not the same
+            difference = compareDatasets(datasets[1], datasets[0])
+            self.assertAlmostEqual(difference, 0.0, places=4)
+
+    def testDefmapNumpyVoxels(self):
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     voxelWriter=VOXELS_NUMPY,
+                                     compressVoxels=True
+                                     )
+        self.launchProtocol(defmap)
+        self.assertTrue(hasattr(defmap, "outputStructureVoxel"))
+        self.assertTrue(defmap.outputStructureVoxel.getFileName().endswith(".pdb.gz"))
+
+        # the viewer reads the compressed voxels as the plain ones
+        plain = self.newProtocol(DefMapNeuralNetwork,
+                                    inputVolume=self.protImportMrc.outputVolume,
+                                    voxelWriter=VOXELS_NUMPY
+                                    )
+        self.launchProtocol(plain)
+        compressedAtoms = readCaAtoms(defmap.outputStructureVoxel.getFileName())
+        plainAtoms = readCaAtoms(plain.outputStructureVoxel.getFileName())
+        self.assertGreater(len(compressedAtoms[0]), 0)
+        for compressedColumn, plainColumn in zip(compressedAtoms, plainAtoms):
+            self.assertTrue(np.array_equal(compressedColumn, plainColumn))
+
+    def testDefmapKdTreeMapping(self):
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     inputStructure=self.protImportPdb.outputPdb,
+                                     atomMapping=MAPPING_RADIUS,
+                                     mappingRadius=2.0
+                                     )
+        self.launchProtocol(defmap)
+        self.assertTrue(hasattr(defmap, "outputStructure"))
+
+    def testDefmapCpu(self):
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     inferenceDevice=INFERENCE_CPU,
+                                     batchSize=64,
+                                     numberOfThreads=2
+                                     )
+        self.launchProtocol(defmap)
+        self.assertTrue(hasattr(defmap, "outputStructureVoxel"))
+
+    def testDefmapOnnx(self):
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     inputStructure=self.protImportPdb.outputPdb,
+                                     inferenceDevice=INFERENCE_CPU,
+                                     inferenceRuntime=RUNTIME_ONNX,
+                                     numberOfThreads=2
+                                     )
+        self.launchProtocol(defmap)
+        self.assertTrue(hasattr(defmap, "outputStructure"))
+
+    def testDefmapTiles(self):
+        reference = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     inferenceDevice=INFERENCE_CPU,
+                                     streamDataset=True,
+                                     numberOfThreads=2,
+                                     useCache=False
+                                     )
+        self.launchProtocol(reference)
+
+        for device in [INFERENCE_CPU, INFERENCE_GPU]:
+            defmap = self.newProtocol(DefMapNeuralNetwork,
+                                         inputVolume=self.protImportMrc.outputVolume,
+                                         inferenceDevice=device,
+                                         streamDataset=True,
+                                         tileSize=40,
+                                         numberOfThreads=2,
+                                         useCache=False
+                                         )
+            self.launchProtocol(defmap)
+            self.assertTrue(hasattr(defmap, "outputStructureVoxel"))
+
+            coordinates, values = readVoxelPredictions(defmap.outputPredictions.getFileName())
+            referenceCoordinates, referenceValues = readVoxelPredictions(reference.outputPredictions.getFileName())
+            self.assertTrue(np.array_equal(coordinates, referenceCoordinates))
+            self.assertTrue(np.allclose(values, referenceValues, atol=1e-3))
+
+    def testDefmapChunkValidation(self):
+        valid = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     streamDataset=True
+                                     )
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     streamDataset=True,
+                                     chunkSize=0,
+                                     tileSize=-1
+                                     )
+        self.assertEqual(len(defmap.validate()), len(valid.validate()) + 2)
+
+        # the scripts refuse them too instead of looping forever
+        volume = np.ones((20, 20, 20), dtype=np.float32)
+        with self.assertRaises(ValueError):
+            next(iterSubvoxels(volume, chunkSize=0))
+        with self.assertRaises(ValueError):
+            next(iterTiles(volume.shape, -1))
+
+    def testDefmapResumable(self):
+        defmap = self.newProtocol(DefMapNeuralNetwork,
+                                     inputVolume=self.protImportMrc.outputVolume,
+                                     inputStructure=self.protImportPdb.outputPdb,
+                                     resumableInference=True,
+                                     chunkSize=1024,
+                                     useCache=False
+                                     )
+        self.launchProtocol(defmap)
+        self.assertTrue(hasattr(defmap, "outputStructure"))
+        self.assertFalse(os.path.exists(defmap._getExtraPath('inference_shards')))
+        referenceCenters, referenceValues = loadPrediction(defmap._getExtraPath('prediction.jbl'))
+
+        # a continued run is a new process that only runs the steps left
+        resumed = self.proj.getProtocol(defmap.getObjId())
+        resumed.setStepsExecutor()
+        os.remove(resumed._getExtraPath('prediction.jbl'))
+
+        # interrupt the inference after two chunks, leaving their shards
+        runDefmap = Plugin.runDefmap
+        Plugin.runDefmap = lambda protocol, script, args, **kwargs: runDefmap(protocol, script, args + ' --max-chunks 2',
+                                                                              **kwargs)
+        try:
+            with self.assertRaises(Exception):
+                resumed.inferenceStep()
+        finally:
+            Plugin.runDefmap = runDefmap
+
+        shards = sorted(glob(resumed._getExtraPath('inference_shards', 'shard-*.npz')))
+        self.assertEqual(len(shards), 2)
+
+        # mark the first shard, its values must reach the prediction if it is reused
+        with np.load(shards[0]) as shard:
+            shardCenters, shardValues = shard['centers'], shard['values']
+        np.savez(shards[0], centers=shardCenters, values=shardValues + 100)
+
+        resumed.inferenceStep()
+        self.assertFalse(os.path.exists(resumed._getExtraPath('inference_shards')))
+        centers, values = loadPrediction(resumed._getExtraPath('prediction.jbl'))
+        self.assertTrue(np.array_equal(centers, referenceCenters))
+
+        marked = len(shardCenters)
+        self.assertTrue(np.allclose(values[:marked], referenceValues[:marked] + 100, atol=1e-4))
+        self.assertTrue(np.allclose(values[marked:], referenceValues[marked:], atol=1e-4))
+
+    def testDefmapBatch(self):
+        defmap = self.newProtocol(DefMapNeuralNetworkBatch,
+                                     inputVolumes=self.protImportVolumes.outputVolumes
+                                     )
+        self.launchProtocol(defmap)
+        self.assertEqual(defmap.outputStructuresVoxel.getSize(), 2)
+        self.assertFalse(hasattr(defmap, "outputStructures"))
+
+    def testDefmapBatchStructures(self):
+        defmap = self.newProtocol(DefMapNeuralNetworkBatch,
+                                     inputVolumes=self.protImportVolumes.outputVolumes,
+                                     inputStructures=[self.protImportPdb.outputPdb, self.protImportPdb.outputPdb]
+                                     )
+        self.launchProtocol(defmap)
+        self.assertEqual(defmap.outputStructuresVoxel.getSize(), 2)
+        self.assertEqual(defmap.outputStructures.getSize(), 2)
+
+        # the links of the inputs are replaced when the step runs again
+        volumeId = defmap.inputVolumes.get().getFirstItem().getObjId()
+        defmap.convertInputStep(volumeId)
+        self.assertTrue(os.path.islink(defmap.getResult(volumeId, 'atomic-structure')))
+
+    def testDefmapReadCaAtoms(self):
+        from Bio.PDB.PDBParser import PDBParser
+
+        fileName = self.protImportPdb.outputPdb.getFileName()
+        chains, residueNames, residues, bfactors = readCaAtoms(fileName)
+
+        structure = PDBParser(QUIET=True).get_structure('REFERENCE', fileName)[0]
+        alphaCarbons = [atom for atom in structure.get_atoms() if atom.get_name() == 'CA']
+        self.assertEqual(chains.tolist(), [atom.get_parent().get_parent().get_id() for atom in alphaCarbons])
+        self.assertEqual(residues.tolist(), [atom.get_parent().get_id()[1] for atom in alphaCarbons])
+        self.assertEqual(bfactors.tolist(), [atom.get_bfactor() for atom in alphaCarbons])
+
+        # the same atoms from a compressed copy
+        compressedFileName = os.path.abspath(self.proj.getTmpPath('5lij.pdb.gz'))
+        with open(fileName, 'rb') as pdbFile, gzip.open(compressedFileName, 'wb') as compressedFile:
+            shutil.copyfileobj(pdbFile, compressedFile)
+        for compressedColumn, column in zip(readCaAtoms(compressedFileName), [chains, residueNames, residues, bfactors]):
+            self.assertTrue(np.array_equal(compressedColumn, column))
+        os.remove(compressedFileName)
@@ -34,12 +34,13 @@ from pwchem.viewers import PyMolViewer
 from os import path, readlink
 from pyworkflow.utils import logger
 import numpy as np
-from Bio.PDB.PDBParser import PDBParser
 from pwem.objects import AtomStruct
 from scipy.stats import pearsonr, linregress
 import os
 from math import pow
 from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from defmap.convert import readVoxelPredictions, readCaAtoms
 
 class DefmapViewer(ProtocolViewer):
   _targets = [DefMapNeuralNetwork, DefmapTestViewer, AtomStruct]
@@ -73,11 +74,15 @@ class DefmapViewer(ProtocolViewer):
      form.addParam('makeGraphExp', params.LabelParam,
                       label='See a graph with b-factors vs RMSF'
                       )
+     form.addParam('makeVoxelHistogram', params.LabelParam,
+                      label='See a histogram of the voxel predictions'
+                      )
   
   def _getVisualizeDict(self):
         return {'openPymol': self._viewPymol,
                 'makeGraph': self._viewGraph,
-                'makeGraphExp': self._viewGraph}
+                'makeGraphExp': self._viewGraph,
+                'makeVoxelHistogram': self._viewVoxelHistogram}
   
   def _viewPymol(self, *args):
    folder = path.split(self.protocol.outputStructure.getFileName())[0]
@@ -100,16 +105,30 @@ class DefmapViewer(ProtocolViewer):
 
      nonzero = self.removeZeros.get()
      
-     handler = PDBParser()
-     
      # set dataframe of defmap output
      if(self.protocol.outputStructure != None):
         defmapFile = self.protocol.outputStructure.getFileName()
      else:
         defmapFile = self.protocol.outputStructureVoxel.getFileName()
-        
+
+     folder = path.split(defmapFile)[0]
+     secondPath = folder+"/structure.pdb"
+     secondFile = None
+
+     if path.exists(secondPath) :
+        secondFile = readlink(secondPath)
+
+     localResFile = None
+     if self.inputLocalRes.hasValue():
+        localResFile = self.inputLocalRes.get().getFileName()
+
+     # the alpha carbons of the three structures are read at the same time
      logger.info("defmap structure: %s" % defmapFile)
-     defmap_st =  handler.get_structure(id='DEFMAP',file=defmapFile)[0]
+     with ThreadPoolExecutor(3) as pool:
+        defmap_st, second_st, localRes_st = pool.map(
+           lambda fileName: readCaAtoms(fileName) if fileName else None,
+           [defmapFile, secondFile, localResFile])
+
      defmap_chainList= self.getChainList(defmap_st)
      self.defmap_atoms = self.getAtomList(defmap_st,log=exponential)
      self.defmap_atoms_arr = self.getBfactors(self.defmap_atoms)
@@ -136,16 +155,8 @@ class DefmapViewer(ProtocolViewer):
 
 
       # set dataframe of second structure
-     folder = path.split(defmapFile)[0]
-     secondPath = folder+"/structure.pdb"
-     secondFile = None
-
-     if path.exists(secondPath) :
-        secondFile = readlink(secondPath)
-
      if secondFile is not None:
       logger.info("second structure: %s" % secondFile)
-      second_st =  handler.get_structure(id='SECOND',file=secondFile)[0]
       second_atoms = self.getAtomList(second_st)
       second_atoms_arr = self.checkAtomsSize(second_atoms)
 
@@ -181,8 +192,6 @@ class DefmapViewer(ProtocolViewer):
 
      if self.inputLocalRes.hasValue():
         # set dataframe of local resolutions
-         localResFile = self.inputLocalRes.get().getFileName()
-         localRes_st =  handler.get_structure(id='LOCALRES',file=localResFile)[0]
          localRes_atoms = self.getAtomList(model=localRes_st)
          localRes_atoms_arr = self.checkAtomsSize(localRes_atoms)
 
@@ -221,6 +230,21 @@ class DefmapViewer(ProtocolViewer):
 
      return [plotter]
   
+  def _viewVoxelHistogram(self, *args):
+     # the compact prediction file is read at once, without parsing the voxel pdb
+     predictions = getattr(self.protocol, 'outputPredictions', None)
+     if predictions is None:
+        logger.info("This run has no voxel predictions file")
+        return []
+
+     _, values = readVoxelPredictions(predictions.getFileName())
+
+     plotter = EmPlotter()
+     plotter.createSubPlot(title="Occurrences of Defmap voxel predictions",
+                           xlabel="log(RMSF(Å))",ylabel="Counts")
+     plotter.plotHist(yValues=values,nbins=100)
+     return [plotter]
+
   def plotChains(self, plotter, idList,defmapModel,extraModel,exp=False,removeZeros=False):
      for chain in idList:  
       defmap_atoms_chain = self.getAtomList(defmapModel, chain, exp)
@@ -299,27 +323,19 @@ class DefmapViewer(ProtocolViewer):
      
   
   def getChainList(self,model):
-     list = []
-     for chain in model.get_chains():
-        list.append(chain.get_id())
-     return list
+     # chains in the order of the file
+     chains = model[0]
+     return chains[np.sort(np.unique(chains, return_index=True)[1])].tolist()
   
   def getAtomList(self,model,chain=None,log=False):
-     if chain is None:
-        atomList = model.get_atoms()
-     else:
-        atomList = model[chain].get_atoms()
-     result = []
-     for atom in atomList:
-        if atom.get_name() == 'CA':
-         if log:
-            value = pow(10,atom.get_bfactor())
-         else:
-            value = atom.get_bfactor()
-            
-         residueIndex = atom.get_full_id()[3][1]
-         result.append((atom.get_parent().get_resname(),value,residueIndex))
-     return result
+     # model holds the arrays of readCaAtoms: chains, residue names, residue numbers and b-factors
+     chains, residueNames, residueIndexes, bfactors = model
+     if chain is not None:
+        selected = chains == chain
+        residueNames, residueIndexes, bfactors = residueNames[selected], residueIndexes[selected], bfactors[selected]
+     if log:
+        bfactors = np.power(10, bfactors)
+     return list(zip(residueNames.tolist(), bfactors.tolist(), residueIndexes.tolist()))
 
 
            